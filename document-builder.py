@@ -6,34 +6,53 @@ Author:
 
 
 import argparse
-from datetime import datetime
-from datetime import timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 import filecmp
+import functools
 import hashlib
+import http.client
+import io
 import json
 import os
+import random
 import re
 import shutil
+import socket
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
 import textwrap
+import threading
 import time
+import urllib.error
+import urllib.parse
+import urllib.request
 import uuid
 import zipfile
+import zlib
 
 # ---------------------------------------------------------
 # Line classification helpers
 # ---------------------------------------------------------
 
-def is_question_heading(line):
-    return re.match(r"^#+\s+Question\b", line, re.IGNORECASE)
+# The headings that have a meaning in assignments. The name of the group
+# that matched is the kind of heading (see parse_assignment_markdown).
+assignment_heading = re.compile(
+    r"^#+\s+(?:Question\s+(?P<question>\d+)|(?P<marks>\d+)\s+marks?"
+    r"|(?P<answer>Answer)\b"
+    r"|(?P<appendix>Appendix|Appendices|Supplementary\s+Material)\b)",
+    re.IGNORECASE,
+)
 
-def is_answer_heading(line):
-    return re.match(r"^#+\s+Answer\b", line, re.IGNORECASE)
-
-def is_appendix_heading(line):
-    return re.match(r"^#+\s+(Appendix|Appendices|Supplementary\s+Material)\b",
-                    line, re.IGNORECASE)
+# The LaTeX anchors put in the instructor version of an assignment before
+# each question and where the questions end, at which it is split into the
+# feedback versions (see split_feedback_ast)
+feedback_anchor = re.compile(r"\\hypertarget\{feedback-(\d+|end)\}\{\}")
 
 def is_pagebreak(line):
     return line.strip() == "\\pagebreak"
@@ -41,22 +60,147 @@ def is_pagebreak(line):
 def is_blank(line):
     return not line.strip()
 
-def classify_line(line):
-    if is_question_heading(line):
-        return "question"
-    if is_answer_heading(line):
-        return "answer"
-    if is_appendix_heading(line):
-        return "appendix"
-    if is_pagebreak(line):
-        return "pagebreak"
-    if is_blank(line):
-        return "blank"
-    return "other"
-
 required_major = 3
 required_minor = 8
 
+# The time spent in each Markdown transform during this run, in seconds
+transform_timings = {}
+
+# The tracked file kinds, config keys and build_includes files that affect
+# each artifact built from a document folder
+license_config_keys = ["license_link_text", "license_link_url", "license_pre_link_text"]
+artifact_inputs = {
+    "markdown": {
+        "files": ["document", "link"],
+        "config": license_config_keys,
+        "includes": [],
+    },
+    "pdf": {
+        "files": ["document", "link", "settings"],
+        "config": license_config_keys + ["pandoc_pdf_engine", "pandoc_highlight_style"],
+        "includes": ["project_pandoc_pdf_template", "project_pandoc_latex_header"],
+    },
+    "html": {
+        "files": ["document", "link", "settings"],
+        "config": license_config_keys,
+        "includes": ["project_pandoc_css_file"],
+    },
+    "feedback": {
+        "files": ["document", "link", "settings"],
+        "config": license_config_keys
+        + ["pandoc_pdf_engine", "pandoc_highlight_style", "feedback_pdf_mode"],
+        "includes": ["project_pandoc_pdf_template", "project_pandoc_latex_header"],
+    },
+    "data": {
+        "files": ["data"],
+        "config": license_config_keys + ["reproducible_data_zips"],
+        "includes": [],
+    },
+}
+
+# Data files that are already compressed are stored in the data zips without
+# being compressed again
+stored_data_extensions = (".gz", ".zip", ".png", ".jpg", ".jpeg", ".bam", ".parquet")
+
+# The records of the data zips, as laid out in PKWARE's APPNOTE.TXT (the .ZIP
+# File Format Specification). zipfile cannot add data that is already
+# compressed, so the zips are written with these (see write_zip_member).
+# Sizes and offsets from zip64_limit up are stored in ZIP64 records instead.
+zip_local_header = struct.Struct("<IHHHHHIIIHH")
+zip_local_header_signature = 0x04034B50
+zip_central_header = struct.Struct("<IHHHHHHIIIHHHHHII")
+zip_central_header_signature = 0x02014B50
+zip_end_record = struct.Struct("<IHHHHIIH")
+zip_end_record_signature = 0x06054B50
+zip64_end_record = struct.Struct("<IQHHIIQQQQ")
+zip64_end_record_signature = 0x06064B50
+zip64_end_locator = struct.Struct("<IIQI")
+zip64_end_locator_signature = 0x07064B50
+zip64_limit = 0xFFFFFFFF
+
+# The ways files can be copied to the output and publish folders (copy_mode)
+copy_modes = ["auto", "reflink", "hardlink", "copy"]
+
+# The ways PDFs can be built (pdf_build_mode), and the LaTeX engines that
+# can be run by the builder itself in "cached" mode
+pdf_build_modes = ["pandoc", "cached"]
+latex_engines = ["pdflatex", "xelatex", "lualatex"]
+
+# The ways the feedback PDFs of assignments can be built (feedback_pdf_mode):
+# each compiled on its own, or split from one PDF of all the questions
+feedback_pdf_modes = ["compile", "split"]
+
+# The output of commands that doesn't change during a run, such as the
+# version of a tool (see get_command_output)
+command_outputs = {}
+
+# Precompiled LaTeX formats are built one at a time
+latex_format_lock = threading.Lock()
+
+# The tools that check the source Markdown, with the log file each writes
+# for every document. Each tool is given up to lint_batch_size documents at
+# a time.
+lint_tools = [
+    (["spellchecker", "--no-suggestions"], "spellchecker.log"),
+    (["markdown-link-check"], "markdown_link_check.log"),
+    (["mdl"], "markdown_lint.log"),
+]
+lint_batch_size = 200
+
+# The config files the external lint tools read by themselves, from the
+# current folder or one of its parents, or else from the home folder
+lint_tool_config_files = {
+    "spellchecker": [
+        ".spellcheckerrc.yml",
+        ".spellcheckerrc.yaml",
+        ".spellcheckerrc.json",
+        ".spellcheckerrc.jsonc",
+    ],
+    "markdown-link-check": [],
+    "mdl": [".mdlrc"],
+}
+
+# The link checkers that can be used (link_checker), and the limits of the
+# built-in one: the number of connections open at a time, overall and to
+# each host, the timeout of each request in seconds, and the number of
+# redirects followed
+link_checkers = ["builtin", "markdown-link-check"]
+link_check_connections = 32
+link_check_host_connections = 4
+link_check_timeout = 20
+link_check_redirects = 5
+
+# The spellcheckers that can be used (spellchecker). The built-in one keeps
+# the results of each paragraph it checks, at most spellcheck_cache_size of
+# them, and ignores the parts of a line matched by spellcheck_ignored: code,
+# links, URLs, email addresses, HTML tags, LaTeX commands and Pandoc
+# attributes.
+spellcheckers = ["builtin", "spellchecker"]
+spellcheck_cache_size = 100000
+spellcheck_ignored = re.compile(
+    "|".join(
+        [
+            r"(`+).*?\1",
+            r"\]\([^)]*\)",
+            r"^\s*\[[^\]]+\]:\s*\S+",
+            r"</?[A-Za-z][^>]*>",
+            r"<[^>\s]+>",
+            r"\b(?:[a-zA-Z][a-zA-Z0-9+.-]*://|www\.)\S+",
+            r"\S+@\S+\.\w+",
+            r"\\[A-Za-z]+",
+            r"\{[#.][^}]*\}",
+        ]
+    )
+)
+spellcheck_word = re.compile(r"(?<![\w'’])[^\W\d_]+(?:['’][^\W\d_]+)*(?![\w'’])")
+
+try:
+    import fcntl
+
+    fcntl_available = True
+except ImportError:
+    fcntl_available = False
+
 try:
     import dropbox
     import dropbox.exceptions
@@ -66,6 +210,158 @@ try:
 except ImportError:
     dropbox_available = False
 
+try:
+    import pypdf
+
+    pypdf_available = True
+except ImportError:
+    pypdf_available = False
+
+
+def build_cached_pdf(folder, ast_file, pdf_file, input_text=None):
+    # Builds pdf_file from the AST in ast_file ("-" for input_text) in a
+    # folder of the build cache that is kept between runs. The LaTeX engine
+    # is only run when the LaTeX changes, and the auxiliary files of the
+    # previous build are reused, so that the engine usually only needs to
+    # run once. With pdflatex, the part of the preamble shared with other
+    # documents is loaded from a precompiled format (see get_latex_format).
+    # Returns a subprocess.CompletedProcess, for run_commands.
+    engine = config.get("pandoc_pdf_engine") or "pdflatex"
+    name = os.path.splitext(os.path.basename(pdf_file))[0]
+    latex_folder = os.path.join(
+        config["project_build_cache_folder"], "latex", folder, name
+    )
+    os.makedirs(latex_folder, exist_ok=True)
+    tex_file = os.path.join(latex_folder, "document.tex")
+    latex_pdf_file = os.path.join(latex_folder, "document.pdf")
+
+    # pandoc leaves out the smart extension when it renders PDFs itself
+    command = [
+        "pandoc",
+        "--from",
+        "json",
+        ast_file,
+        "--to",
+        "latex-smart",
+        "--standalone",
+        "--extract-media",
+        os.path.abspath(os.path.join(latex_folder, "media")),
+        "-o",
+        f"{tex_file}.tmp",
+    ]
+    command.extend(get_latex_options(folder))
+    result = subprocess.run(
+        command,
+        input=input_text,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    if result.returncode != 0:
+        return result
+    pandoc_output = result.stdout
+
+    with open(f"{tex_file}.tmp", "r") as f:
+        lines = f.read().splitlines(keepends=True)
+    os.remove(f"{tex_file}.tmp")
+
+    format_name = None
+    if engine == "pdflatex":
+        latex_format = get_latex_format(lines)
+        if latex_format:
+            format_name, dumped_lines = latex_format
+            lines.insert(dumped_lines, "\\endofdump\n")
+
+    if write_file_if_changed(tex_file, "".join(lines)) or not os.path.exists(
+        latex_pdf_file
+    ):
+        result = run_latex(engine, latex_folder, format_name)
+        if result.returncode != 0:
+            # the LaTeX is built again on the next run
+            os.remove(tex_file)
+            result.stdout = pandoc_output + result.stdout
+            return result
+
+    shutil.copyfile(latex_pdf_file, pdf_file)
+    return subprocess.CompletedProcess(command, 0, stdout=pandoc_output)
+
+
+def build_feedback_pdfs(
+    folder, instructor_command, instructor_pdf, feedback_asts, pdf_folder, input_text=None
+):
+    # Builds the instructor version of an assignment with instructor_command,
+    # and splits it with pypdf into the feedback PDF of each question, at the
+    # anchors before each question and where the questions end (see
+    # generate_assignment_markdown), which start a new page in this mode.
+    # feedback_asts maps each question number to its AST (see
+    # split_feedback_ast). The feedback PDFs are compiled one by one instead
+    # if the anchors can't be found. Returns a subprocess.CompletedProcess,
+    # for run_commands.
+    def run(command, input_text):
+        if callable(command):
+            return command(input_text)
+        return subprocess.run(
+            command,
+            input=input_text,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+
+    result = run(instructor_command, None)
+    if result.returncode != 0:
+        return result
+
+    # the first page of each question, in the order of the questions, and
+    # the first page after the questions
+    try:
+        reader = pypdf.PdfReader(instructor_pdf)
+        destinations = reader.named_destinations
+        pages = [
+            reader.get_destination_page_number(destinations[f"feedback-{number}"])
+            for number in feedback_asts
+        ]
+        if "feedback-end" in destinations:
+            pages.append(
+                reader.get_destination_page_number(destinations["feedback-end"])
+            )
+        else:
+            pages.append(len(reader.pages))
+    except (KeyError, OSError, pypdf.errors.PyPdfError):
+        pages = [-1]
+    if min(pages) < 0 or pages != sorted(set(pages)):
+        output = [
+            result.stdout,
+            "The instructor PDF could not be split, compiling each question instead",
+        ]
+        for question_number, feedback_ast in feedback_asts.items():
+            pdf_file = os.path.join(
+                pdf_folder, f"document_feedback_{question_number}.pdf"
+            )
+            unlink_hardlinked_file(pdf_file)
+            result = run(get_pdf_command(folder, "-", pdf_file), json.dumps(feedback_ast))
+            output.append(result.stdout)
+            if result.returncode != 0:
+                break
+        return subprocess.CompletedProcess(
+            result.args, result.returncode, "\n".join(filter(None, output))
+        )
+
+    # the files are replaced rather than rewritten, since they may be hard
+    # linked to the published copies (see copy_file)
+    for question_number, first_page, last_page in zip(
+        feedback_asts, pages, pages[1:]
+    ):
+        writer = pypdf.PdfWriter()
+        for page in range(first_page, last_page):
+            writer.add_page(reader.pages[page])
+        pdf_file = os.path.join(
+            pdf_folder, f"document_feedback_{question_number}.pdf"
+        )
+        writer.write(f"{pdf_file}.tmp")
+        os.replace(f"{pdf_file}.tmp", pdf_file)
+    return result
+
 
 def check_executables(executables, verbose=False):
     for executable, link in executables.items():
@@ -78,6 +374,66 @@ def check_executables(executables, verbose=False):
             sys.exit(1)
 
 
+def check_urls(urls):
+    # Checks each URL with a HEAD request, falling back to GET when the
+    # server rejects HEAD, and follows up to link_check_redirects redirects.
+    # link_check_connections URLs are checked at a time, at most
+    # link_check_host_connections of them on the same host. Returns a dict
+    # mapping each URL to its (status, alive), where status is the final
+    # HTTP status or the error that stopped the check.
+    redirect_handler = urllib.request.HTTPRedirectHandler()
+    redirect_handler.max_redirections = link_check_redirects
+    opener = urllib.request.build_opener(redirect_handler)
+    host_limits = {}
+
+    def get_host(url):
+        # the URLs start with http:// or https://
+        return url.split("/", 3)[2].lower()
+
+    def send_request(method, url):
+        request = urllib.request.Request(
+            url, method=method, headers={"User-Agent": "document-builder"}
+        )
+        try:
+            with opener.open(request, timeout=link_check_timeout) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.close()
+            if e.msg.startswith(redirect_handler.inf_msg):
+                raise ValueError("Too many redirects")
+            return e.code
+
+    def check_url(url):
+        host_limit = host_limits.setdefault(
+            get_host(url), threading.Semaphore(link_check_host_connections)
+        )
+        try:
+            with host_limit:
+                status = send_request("HEAD", url)
+                if status >= 400:
+                    status = send_request("GET", url)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            reason = getattr(e, "reason", e)
+            if isinstance(reason, socket.timeout):
+                return "Timed out", False
+            return str(reason) or type(reason).__name__, False
+        return status, 200 <= status < 300
+
+    # the URLs of each host take turns with those of the other hosts, so
+    # that the workers are not all waiting for the same host
+    hosts = {}
+    for url in urls:
+        hosts.setdefault(get_host(url), []).append(url)
+    ordered_urls = []
+    for index in range(max(len(host_urls) for host_urls in hosts.values())):
+        ordered_urls.extend(
+            host_urls[index] for host_urls in hosts.values() if index < len(host_urls)
+        )
+
+    with ThreadPoolExecutor(max_workers=link_check_connections) as executor:
+        return dict(zip(ordered_urls, executor.map(check_url, ordered_urls)))
+
+
 def check_file_exists(file_path):
     if not os.path.isfile(file_path):
         pretty_print_error(f"File '{file_path}' does not exist.")
@@ -92,6 +448,29 @@ def check_folder_exists(folder_path):
     return True
 
 
+def check_spelling(lines, words):
+    # Returns the misspelt words of a paragraph as [line index, column,
+    # word] lists. A word is also accepted if its lowercase form is in
+    # words, or if it is in capitals and its capitalized form is (e.g. "THE"
+    # and "PARIS"), and a possessive if the word without "'s" is.
+    misspelt = []
+    for index, line in enumerate(lines):
+        line = spellcheck_ignored.sub(lambda match: " " * len(match.group()), line)
+        for match in spellcheck_word.finditer(line):
+            word = match.group().replace("’", "'")
+            candidates = [word]
+            if word.endswith("'s"):
+                candidates.append(word[:-2])
+            if not any(
+                candidate in words
+                or candidate.lower() in words
+                or (candidate.isupper() and candidate.capitalize() in words)
+                for candidate in candidates
+            ):
+                misspelt.append([index, match.start(), match.group()])
+    return misspelt
+
+
 def clean_folder(folder_path):
     if not prompt_yes_no(
         f"Are you sure you want to delete all files in {folder_path}?", default=False
@@ -109,63 +488,393 @@ def clean_folder(folder_path):
             pretty_print_error(f"Failed to delete {file_path}. Reason: {e}")
 
 
-def copy_and_compress_data_folders(folders):
-    source_folder = config["project_source_folder"]
+def compress_data_folder(folder_name, executor, jobs, compressed_limit, force=False):
+    # The zip is written straight from the source data folders, without
+    # copying the data first. In reproducible mode the members are sorted and
+    # their timestamps and permissions are fixed, so unchanged data gives a
+    # byte-identical zip. Members are compressed by the executor, at most
+    # jobs ahead of the member being written, and written in order. Each
+    # compressed member waiting to be written holds compressed_limit, which
+    # is shared by all folders and bounds the memory of the spooled members.
+    # Members whose file is unchanged since the previous zip, according to
+    # the manifest written next to it, are copied from it without being
+    # compressed again, unless force is set. If none of them changed, the
+    # previous zip is kept as it is.
+    reproducible = config.get("reproducible_data_zips", True)
+    data_files = get_data_files(folder_name)
+    if not data_files:
+        return
 
-    for folder_name in folders:
-        new_file_generated = False
-        output_data_folder = os.path.join(
-            config["project_data_output_folder"], folder_name
+    # members are (arcname, source path), the license has no source path
+    members = [
+        (os.path.join(folder_name, relative_path), file_path)
+        for relative_path, file_path in data_files.items()
+    ]
+    license_markdown = get_license_as_markdown()
+    if license_markdown != "" and "license.md" not in data_files:
+        members.append((os.path.join(folder_name, "license.md"), None))
+    if reproducible:
+        members.sort()
+
+    zip_file = os.path.join(config["project_data_output_folder"], f"{folder_name}.zip")
+    manifest_file = f"{zip_file}.json"
+    temporary_zip_file = f"{zip_file}.tmp"
+
+    previous_members = {}
+    previous_manifest = {}
+    if not force and os.path.exists(zip_file) and os.path.exists(manifest_file):
+        try:
+            with zipfile.ZipFile(zip_file) as previous_zip:
+                previous_members = {
+                    zinfo.filename: zinfo for zinfo in previous_zip.infolist()
+                }
+            with open(manifest_file, "r") as f:
+                previous_manifest = json.load(f)
+        except (zipfile.BadZipFile, json.JSONDecodeError):
+            previous_members = {}
+            previous_manifest = {}
+
+    def get_previous_member(zinfo, file_hash):
+        # Returns the member of the previous zip with the same content and
+        # attributes, if it has not moved since the manifest was written
+        entry = previous_manifest.get(zinfo.filename)
+        if entry is None or entry["hash"] != file_hash:
+            return None
+        previous_zinfo = previous_members.get(zinfo.filename)
+        if previous_zinfo is None or (
+            previous_zinfo.header_offset,
+            previous_zinfo.compress_size,
+            previous_zinfo.CRC,
+        ) != (entry["offset"], entry["compress_size"], entry["crc"]):
+            return None
+        # zip timestamps have a resolution of two seconds
+        date_time = (*zinfo.date_time[:5], zinfo.date_time[5] // 2 * 2)
+        if (
+            previous_zinfo.compress_type,
+            previous_zinfo.date_time,
+            previous_zinfo.external_attr,
+            previous_zinfo.create_system,
+        ) != (
+            zinfo.compress_type,
+            date_time,
+            zinfo.external_attr,
+            zinfo.create_system,
+        ):
+            return None
+        return previous_zinfo
+
+    def is_previous_license(zinfo):
+        # The license has no manifest entry, so it is compared with the
+        # license in the previous zip. Outside reproducible mode it is given
+        # the current time, which is ignored here.
+        previous_zinfo = previous_members.get(zinfo.filename)
+        if previous_zinfo is None or (
+            previous_zinfo.compress_type,
+            previous_zinfo.external_attr,
+            previous_zinfo.create_system,
+        ) != (zinfo.compress_type, zinfo.external_attr, zinfo.create_system):
+            return False
+        if reproducible and previous_zinfo.date_time != zinfo.date_time:
+            return False
+        with zipfile.ZipFile(zip_file) as previous_zip:
+            return previous_zip.read(zinfo.filename) == (
+                license_markdown + "\n"
+            ).encode("utf-8")
+
+    manifest = {}
+    planned_members = []
+    for arcname, file_path in members:
+        if file_path is None:
+            zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+            zinfo.external_attr = 0o600 << 16
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        else:
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+            if file_path.lower().endswith(stored_data_extensions):
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+
+        if reproducible:
+            zinfo.date_time = (1980, 1, 1, 0, 0, 0)
+            zinfo.external_attr = (stat.S_IFREG | 0o644) << 16
+            zinfo.create_system = 3  # Unix
+
+        previous_zinfo = None
+        if file_path is not None:
+            file_stat = os.stat(file_path)
+            entry = previous_manifest.get(zinfo.filename)
+            if entry is not None and (entry["size"], entry["mtime_ns"]) == (
+                file_stat.st_size,
+                file_stat.st_mtime_ns,
+            ):
+                file_hash = entry["hash"]
+            else:
+                file_hash = get_data_file_hash(
+                    file_path, file_stat.st_size, file_stat.st_mtime_ns
+                )
+            manifest[zinfo.filename] = {
+                "size": file_stat.st_size,
+                "mtime_ns": file_stat.st_mtime_ns,
+                "hash": file_hash,
+            }
+            zinfo.file_size = file_stat.st_size
+            zinfo.compress_size = file_stat.st_size
+            previous_zinfo = get_previous_member(zinfo, file_hash)
+        planned_members.append((zinfo, file_path, previous_zinfo))
+
+    # the zip is left untouched when it has the same members and none of
+    # them changed, so that it keeps its modification time and is not
+    # published or uploaded again
+    if (
+        previous_members
+        and [zinfo.filename for zinfo, _, _ in planned_members]
+        == list(previous_members)
+        and all(
+            (
+                previous_zinfo is not None
+                if file_path is not None
+                else is_previous_license(zinfo)
+            )
+            for zinfo, file_path, previous_zinfo in planned_members
         )
+    ):
+        for zinfo, file_path, previous_zinfo in planned_members:
+            if file_path is not None:
+                manifest[zinfo.filename].update(
+                    {
+                        "offset": previous_zinfo.header_offset,
+                        "compress_size": previous_zinfo.compress_size,
+                        "crc": previous_zinfo.CRC,
+                    }
+                )
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=4)
+        return
 
-        for data_folder_name in ["data", "data_not_tracked"]:
-            source_data_folder = os.path.join(
-                source_folder, folder_name, data_folder_name
-            )
-            if os.path.exists(source_data_folder):
-                visible_files = [
-                    name
-                    for name in os.listdir(source_data_folder)
-                    if not name.startswith(".")
-                ]
-                if not visible_files:  # Skip if no visible files
-                    continue
-                # Create output_data_folder only if there are visible files
-                os.makedirs(output_data_folder, exist_ok=True)
-                for item in visible_files:
-                    item_path = os.path.join(source_data_folder, item)
-                    if os.path.isfile(item_path):
-                        shutil.copy2(item_path, output_data_folder)
-                    else:
-                        shutil.copytree(
-                            item_path,
-                            os.path.join(output_data_folder, item),
-                            dirs_exist_ok=True,
+    written_members = []
+    previous_file = open(zip_file, "rb") if previous_members else None
+    try:
+        with open(temporary_zip_file, "wb") as output:
+
+            def write_member(zinfo, file_path, previous_zinfo, future):
+                if previous_zinfo is not None:
+                    # the data follows the local header, which ends with the
+                    # file name and extra field
+                    previous_file.seek(previous_zinfo.header_offset)
+                    header = zip_local_header.unpack(
+                        previous_file.read(zip_local_header.size)
+                    )
+                    if header[0] != zip_local_header_signature:
+                        raise zipfile.BadZipFile(
+                            f"Bad local header for {zinfo.filename} in {zip_file}"
                         )
-                new_file_generated = True
+                    previous_file.seek(header[9] + header[10], os.SEEK_CUR)
+                    zinfo.CRC = previous_zinfo.CRC
+                    zinfo.file_size = previous_zinfo.file_size
+                    zinfo.compress_size = previous_zinfo.compress_size
+                    write_zip_member(output, zinfo, previous_file)
+                elif future is not None:
+                    try:
+                        (
+                            zinfo.CRC,
+                            zinfo.file_size,
+                            zinfo.compress_size,
+                            compressed_file,
+                        ) = future.result()
+                        with compressed_file:
+                            write_zip_member(output, zinfo, compressed_file)
+                    finally:
+                        compressed_limit.release()
+                elif file_path is None:
+                    content = (license_markdown + "\n").encode("utf-8")
+                    compressor = zlib.compressobj(
+                        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+                    )
+                    compressed = compressor.compress(content) + compressor.flush()
+                    zinfo.CRC = zlib.crc32(content)
+                    zinfo.file_size = len(content)
+                    zinfo.compress_size = len(compressed)
+                    write_zip_member(output, zinfo, io.BytesIO(compressed))
+                else:
+                    # stored as it is, with the CRC-32 computed while copying
+                    zinfo.CRC = None
+                    with open(file_path, "rb") as source:
+                        write_zip_member(output, zinfo, source)
+                written_members.append(zinfo)
+                if file_path is not None:
+                    manifest[zinfo.filename].update(
+                        {
+                            "offset": zinfo.header_offset,
+                            "compress_size": zinfo.compress_size,
+                            "crc": zinfo.CRC,
+                        }
+                    )
 
-        if new_file_generated:
-            license_markdown = get_license_as_markdown()
-            if license_markdown != "" and not os.path.exists(
-                os.path.join(output_data_folder, "license.md")
-            ):
-                with open(os.path.join(output_data_folder, "license.md"), "w") as f:
-                    f.write(license_markdown + "\n")
+            pending_members = deque()
+            for zinfo, file_path, previous_zinfo in planned_members:
+                future = None
+                if (
+                    file_path is not None
+                    and previous_zinfo is None
+                    and zinfo.compress_type == zipfile.ZIP_DEFLATED
+                ):
+                    # a folder never blocks while it holds compressed
+                    # members, so the folders cannot wait for each other:
+                    # if no member can be compressed now, this folder's own
+                    # pending members are written first
+                    if not compressed_limit.acquire(blocking=False):
+                        while pending_members:
+                            write_member(*pending_members.popleft())
+                        compressed_limit.acquire()
+                    future = executor.submit(compress_zip_member, file_path)
+                pending_members.append((zinfo, file_path, previous_zinfo, future))
+                while len(pending_members) > jobs:
+                    write_member(*pending_members.popleft())
+            while pending_members:
+                write_member(*pending_members.popleft())
+
+            write_zip_central_directory(output, written_members)
+    finally:
+        if previous_file is not None:
+            previous_file.close()
+
+    os.replace(temporary_zip_file, zip_file)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def compress_data_folders(folders, jobs=1, force=False):
+    # Folders are compressed in parallel, and so are the members of each
+    # folder. Since members are compressed independently and written in
+    # order, the zips do not depend on the number of jobs. At most 2 * jobs
+    # compressed members wait to be written at any time, across all folders.
+    os.makedirs(config["project_data_output_folder"], exist_ok=True)
+    compressed_limit = threading.Semaphore(2 * jobs)
+
+    with ThreadPoolExecutor(max_workers=jobs) as member_executor:
+        with ThreadPoolExecutor(max_workers=jobs) as folder_executor:
+            futures = [
+                folder_executor.submit(
+                    compress_data_folder,
+                    folder_name,
+                    member_executor,
+                    jobs,
+                    compressed_limit,
+                    force,
+                )
+                for folder_name in folders
+            ]
+            for future in futures:
+                future.result()
+
+
+def compress_zip_member(file_path):
+    # Deflates a file the same way zipfile does, into a temporary file.
+    # Returns the CRC-32 and size of the file, and the size of the compressed
+    # data along with the compressed file.
+    compressed_file = tempfile.SpooledTemporaryFile(
+        max_size=16 * 1024 * 1024, dir=config["project_data_output_folder"]
+    )
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+    compress_size = 0
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            compress_size += compressed_file.write(compressor.compress(chunk))
+    compress_size += compressed_file.write(compressor.flush())
+    compressed_file.seek(0)
+    return crc, file_size, compress_size, compressed_file
+
+
+def copy_file(source_file, destination_file):
+    # Copies a file to the output and publish folders, unless the destination
+    # already has the same content. Depending on copy_mode the file is cloned
+    # (reflink), hard linked (hardlink) or copied (copy). In auto mode a
+    # reflink is tried first, then copy_file_range, then a normal copy. The
+    # destination is replaced atomically. Returns True if the file was copied.
+    copy_mode = config.get("copy_mode", "auto")
+
+    if os.path.exists(destination_file):
+        if os.path.samefile(source_file, destination_file):
+            return False
+        source_stat = os.stat(source_file)
+        destination_stat = os.stat(destination_file)
+        # copies keep the modification time of the source, so a destination
+        # with the same size and modification time is the same file
+        if source_stat.st_size == destination_stat.st_size and (
+            source_stat.st_mtime_ns == destination_stat.st_mtime_ns
+            or filecmp.cmp(source_file, destination_file, shallow=False)
+        ):
+            return False
+
+    temporary_file = os.path.join(
+        os.path.dirname(destination_file),
+        f".{os.path.basename(destination_file)}.{uuid.uuid4().hex}.tmp",
+    )
+    try:
+        copied = False
+        if copy_mode == "hardlink":
+            try:
+                os.link(source_file, temporary_file)
+                copied = True
+            except OSError:
+                pass  # e.g. across devices
+
+        if not copied and copy_mode in ["auto", "reflink"]:
+            copied = copy_file_contents(source_file, temporary_file)
+
+        if not copied:
+            shutil.copy2(source_file, temporary_file)
+        elif copy_mode != "hardlink":
+            shutil.copystat(source_file, temporary_file)
+
+        os.replace(temporary_file, destination_file)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+    return True
 
-            with zipfile.ZipFile(
-                f"{output_data_folder}.zip", "w", zipfile.ZIP_DEFLATED
-            ) as zipf:
-                for root, _, files in os.walk(output_data_folder):
-                    for file in files:
-                        if not file.startswith("."):  # Exclude hidden files
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.join(
-                                os.path.basename(output_data_folder),
-                                os.path.relpath(file_path, output_data_folder),
-                            )
-                            zipf.write(file_path, arcname=arcname)
 
-            shutil.rmtree(output_data_folder)  # Remove the folder after compression
+def copy_file_contents(source_file, destination_file):
+    # Copies the contents of a file without reading them into Python, with a
+    # reflink (FICLONE) if the filesystem supports it, otherwise with
+    # copy_file_range. Returns False if neither is supported, in which case
+    # nothing is written.
+    copy_mode = config.get("copy_mode", "auto")
+
+    with open(source_file, "rb") as source, open(destination_file, "wb") as destination:
+        if fcntl_available and sys.platform.startswith("linux"):
+            try:
+                # FICLONE is only defined by the fcntl module in Python 3.12
+                fcntl.ioctl(
+                    destination.fileno(),
+                    getattr(fcntl, "FICLONE", 0x40049409),
+                    source.fileno(),
+                )
+                return True
+            except OSError:
+                pass
+
+        if copy_mode == "auto" and hasattr(os, "copy_file_range"):
+            try:
+                remaining = os.fstat(source.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(
+                        source.fileno(), destination.fileno(), remaining
+                    )
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return True
+            except OSError:
+                pass  # e.g. across devices on older kernels
+            destination.truncate(0)
+    return False
 
 
 def copy_source_folders_to_markdown_output(folders):
@@ -177,30 +886,50 @@ def copy_source_folders_to_markdown_output(folders):
             config["project_markdown_output_folder"], folder_name
         )
 
-        # Create the output folder if it doesn't exist
+        # Create the output folder if it doesn't exist. The document itself is
+        # written by write_markdown_documents once it has been transformed.
         os.makedirs(markdown_output_folder, exist_ok=True)
 
-        # Copy document.md
-        shutil.copy2(
-            os.path.join(source_folder_path, "document.md"), markdown_output_folder
-        )
-
         # Check if the includes folder exists in the source folder
         includes_source_path = os.path.join(source_folder_path, "includes")
         includes_output_path = os.path.join(markdown_output_folder, "includes")
 
         if os.path.exists(includes_source_path) and os.path.isdir(includes_source_path):
             # Copy includes folder if it exists
-            shutil.copytree(
-                includes_source_path,
-                includes_output_path,
-                dirs_exist_ok=True,
-            )
+            copy_tree(includes_source_path, includes_output_path)
         else:
             # Create an empty includes folder in the markdown output if it doesn't exist
             os.makedirs(includes_output_path, exist_ok=True)
 
 
+def copy_tree(source_folder, destination_folder, delete=False):
+    # Copies every file in source_folder into destination_folder with
+    # copy_file. If delete is set, files and folders in
+    # destination_folder that are not in source_folder are removed.
+    # copied_paths holds the paths copied, relative to destination_folder.
+    copied_paths = set()
+    for root, _dirs, files in os.walk(source_folder):
+        relative_root = os.path.relpath(root, source_folder)
+        destination_root = os.path.join(destination_folder, relative_root)
+        os.makedirs(destination_root, exist_ok=True)
+        copied_paths.add(os.path.normpath(relative_root))
+        for file in files:
+            copy_file(os.path.join(root, file), os.path.join(destination_root, file))
+            copied_paths.add(os.path.normpath(os.path.join(relative_root, file)))
+
+    if delete:
+        for root, dirs, files in os.walk(destination_folder, topdown=False):
+            relative_root = os.path.relpath(root, destination_folder)
+            for file in files:
+                relative_path = os.path.normpath(os.path.join(relative_root, file))
+                if relative_path not in copied_paths:
+                    os.remove(os.path.join(root, file))
+            for folder in dirs:
+                relative_path = os.path.normpath(os.path.join(relative_root, folder))
+                if relative_path not in copied_paths:
+                    shutil.rmtree(os.path.join(root, folder))
+
+
 def create_link_files(folders):
     data_output_folder = config["project_data_output_folder"]
     data_to_share_links_folder = config["project_data_to_share_links_folder"]
@@ -225,6 +954,7 @@ def create_project(folder_path, include_example_documents=False):
     os.makedirs(folder_path)
 
     subfolders = [
+        "cache",
         "config",
         "logs",
         "data",
@@ -273,6 +1003,7 @@ def create_project(folder_path, include_example_documents=False):
             "project_pandoc_pdf_template",
             "project_pandoc_latex_header",
             "project_pandoc_css_file",
+            "project_spellchecker_words",
         ]:
             if check_file_exists(value):
                 shutil.copy2(value, os.path.join(folder_path, "build_includes"))
@@ -307,292 +1038,314 @@ def create_project(folder_path, include_example_documents=False):
     pretty_print("Project created successfully.")
 
 
-def create_timestamp_files(folders):
-    build_logs_folder = config["project_build_logs_folder"]
-    data_to_share_links_folder = config["project_data_to_share_links_folder"]
-    project_source_folder = config["project_source_folder"]
-
-    for folder in folders:
-        folder_log_folder = os.path.join(build_logs_folder, folder)
-        os.makedirs(folder_log_folder, exist_ok=True)
-
-        # Create or update the timestamp file
-        timestamp_file = os.path.join(folder_log_folder, "timestamp.txt")
-        with open(timestamp_file, "w") as f:
-            f.write(str(time.time()))
+def finish_dropbox_upload_sessions(dbx, upload_sessions):
+    # Commits the closed upload sessions of several files in one request (up to
+    # 1000 per request) and returns the names of the committed files. A
+    # session can only be committed once, so its record is removed whatever
+    # the outcome.
+    committed_files = []
+    for start in range(0, len(upload_sessions), 1000):
+        batch = upload_sessions[start : start + 1000]
+        result = dbx.files_upload_session_finish_batch_v2(
+            [finish_arg for _, _, finish_arg in batch]
+        )
+        for (file_name, source_data_file, _), entry in zip(batch, result.entries):
+            if entry.is_success():
+                pretty_print(f"Uploaded {file_name} to Dropbox", True)
+                committed_files.append(file_name)
+            else:
+                pretty_print_error(
+                    f"Failed to commit {file_name} to Dropbox: {entry.get_failure()}"
+                )
+            with build_state_lock, build_state:
+                build_state.execute(
+                    "DELETE FROM upload_sessions WHERE path = ?",
+                    (os.path.abspath(source_data_file),),
+                )
+    return committed_files
+
+
+def generate_assignment_markdown(documents):
+    # documents maps each folder to its transformed Markdown. Returns a dict
+    # mapping each folder to a dict of {file name: content} holding the
+    # student and instructor versions of the assignment, which are both made
+    # from the model of the assignment (see parse_assignment_markdown). The
+    # feedback versions are split from the instructor version's AST.
+    assignment_documents = {}
+
+    for folder, content in documents.items():
+        files = {}
+        assignment = parse_assignment_markdown(content)
+        lines = list(assignment["lines"])
+        headings = assignment["headings"]
+
+        # insert total marks into the first heading
+        total_marks = sum(int(value) for _, kind, value in headings if kind == "marks")
+        if total_marks != 0 and headings:
+            index = headings[0][0]
+            lines[index] = f"{lines[index].rstrip()} ({total_marks} marks total)"
+
+        # the instructor version includes the answers, and an anchor before
+        # each question and where the questions end
+        anchors = {
+            index: number
+            for index, kind, number in headings
+            if kind == "question" and index < assignment["end"]
+        }
+        if anchors and assignment["end"] < len(lines):
+            anchors[assignment["end"]] = "end"
+        # anchors start a new page when the feedback PDFs are split from the
+        # instructor PDF (see build_feedback_pdfs)
+        if config.get("feedback_pdf_mode", "compile") == "split":
+            anchor_lines = ["\\clearpage"]
+        else:
+            anchor_lines = []
+        instructor_lines = []
+        for index, line in enumerate(lines):
+            if index in anchors:
+                anchor = f"\\hypertarget{{feedback-{anchors[index]}}}{{}}"
+                instructor_lines.extend(
+                    ["", "```{=latex}"] + anchor_lines + [anchor, "```", ""]
+                )
+            instructor_lines.append(line)
+        ending = "\n" if content.endswith("\n") else ""
+        files["document_instructor.md"] = "\n".join(instructor_lines) + ending
+
+        # create copy of document with answers removed. An answer runs from
+        # its heading to the next heading, and the blank lines and page
+        # breaks at its end are kept. An answer with no content only loses
+        # its heading.
+        new_lines = []
+        kept_from = 0
+        for position, (index, kind, _) in enumerate(headings):
+            if kind != "answer":
+                continue
+            if position + 1 < len(headings):
+                next_heading = headings[position + 1][0]
+            else:
+                next_heading = len(lines)
+            new_lines.extend(lines[kept_from:index])
+            kept_from = next_heading
+            while kept_from > index + 1 and lines[kept_from - 1].strip() in (
+                "",
+                "\\pagebreak",
+            ):
+                kept_from -= 1
+        new_lines.extend(lines[kept_from:])
 
-        # Generate the file list
-        file_list_file = os.path.join(folder_log_folder, "file_list.txt")
-        files_in_folder = []
+        # the student version has the answers removed and the license added
+        files["document.md"] = transform_license(folder, "\n".join(new_lines))
 
-        # Collect files in the source folder and subfolders
-        source_folder = project_source_folder  # Base directory for consistency
-        for root, _, files in os.walk(os.path.join(project_source_folder, folder)):
-            for file in files:
-                # Skip hidden files (files that start with a dot)
-                if not file.startswith("."):
-                    file_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(
-                        file_path, start=project_source_folder
-                    )
-                    files_in_folder.append(relative_path)
+        assignment_documents[folder] = files
 
-        # Include data_to_share_links_file
-        data_link_file = os.path.join(data_to_share_links_folder, f"{folder}.txt")
-        if os.path.exists(data_link_file) and not os.path.basename(
-            data_link_file
-        ).startswith("."):
-            relative_path = os.path.relpath(data_link_file, start=project_source_folder)
-            files_in_folder.append(relative_path)
+    return assignment_documents
 
-        # Sort the file list for consistency
-        files_in_folder.sort()
 
-        # Write the file list to file_list.txt
-        with open(file_list_file, "w") as f:
-            for file_path in files_in_folder:
-                f.write(f"{file_path}\n")
+def generate_assignment_pdfs(documents, pdf_folders, feedback_folders, jobs=1):
+    # documents maps each folder to a dict of {file name: content}, as
+    # returned by generate_assignment_markdown. The student and instructor
+    # versions are parsed once, and the feedback PDFs are either rendered
+    # from the questions of the instructor version's AST, each on its own,
+    # or split from the instructor PDF (see build_feedback_pdfs).
+    pdf_output_folder = config["project_pdf_output_folder"]
+    split_feedback = (
+        config.get("feedback_pdf_mode", "compile") == "split" and pypdf_available
+    )
 
+    to_parse = {}
+    for folder, files in documents.items():
+        to_parse[folder] = {}
+        if folder in pdf_folders:
+            to_parse[folder]["document.md"] = files["document.md"]
+        if folder in pdf_folders or folder in feedback_folders:
+            to_parse[folder]["document_instructor.md"] = files["document_instructor.md"]
+    ast_files, parse_failures = parse_documents(to_parse, jobs)
+
+    failures = []
+    for (folder, file), label, reason in parse_failures:
+        if file == "document_instructor.md" and folder in feedback_folders:
+            failures.append(((folder, "feedback"), label, reason))
+        if folder in pdf_folders:
+            failures.append(((folder, "pdf"), label, reason))
+
+    commands = []
+    # the size of the AST rendered by each command
+    sizes = []
+    # the folders whose feedback PDFs are split from the instructor PDF
+    split_folders = []
+    for folder, files in ast_files.items():
+        # remove feedback PDFs for questions that no longer exist
+        if folder in feedback_folders:
+            for output in get_artifact_outputs(folder, "feedback"):
+                os.remove(output)
 
-def edit_markdown_includes(folders):
-    markdown_output_folder = config["project_markdown_output_folder"]
+        pdf_folder = os.path.join(pdf_output_folder, folder)
+        os.makedirs(pdf_folder, exist_ok=True)
 
-    for folder in folders:
-        markdown_file = os.path.join(markdown_output_folder, folder, "document.md")
-        includes_dir = os.path.join(markdown_output_folder, folder, "includes")
-        with open(markdown_file, "r+") as f:
-            content = f.read()
-            matches = re.findall(r"!\[.*\]\((.*\..*)\)", content)
-            for match in matches:
-                old_image_path = os.path.join(includes_dir, os.path.basename(match))
-                if os.path.exists(old_image_path):
-                    with open(old_image_path, "rb") as img_f:
-                        bytes = img_f.read()  # read entire file as bytes
-                        readable_hash = hashlib.md5(bytes).hexdigest()
-                        # hash the bytes
-                        new_image_name = f"{readable_hash}{os.path.splitext(match)[1]}"
-                        new_image_path = os.path.join(includes_dir, new_image_name)
-                        os.rename(old_image_path, new_image_path)
-                    content = content.replace(
-                        match, os.path.join("includes", new_image_name)
+        outputs = []
+        if folder in pdf_folders:
+            for file in ["document.md", "document_instructor.md"]:
+                if file in files:
+                    outputs.append(
+                        ("pdf", file.replace(".md", ".pdf"), files[file], None)
                     )
-            f.seek(0)
-            f.write(content)
-            f.truncate()
-
-
-def generate_assignment_markdown(folders):
-    markdown_output_folder = config["project_markdown_output_folder"]
-
-    for folder in folders:
-        markdown_file = os.path.join(markdown_output_folder, folder, "document.md")
-
-        # determine total marks
-        with open(markdown_file, "r") as f:
-            content = f.read()
-            in_code_block = False
-            total_marks = 0
-            for line in content.splitlines():
-                if line.strip().startswith("```"):
-                    in_code_block = not in_code_block
-                elif not in_code_block:
-                    match = re.match(r"^#+ (\d+) marks?", line, re.IGNORECASE)
-                    if match:
-                        total_marks += int(match.group(1))
-
-        # insert total marks into document.md
-        if total_marks != 0:
-            with open(markdown_file, "r+") as f:
-                lines = f.readlines()
-                f.seek(0)
-                f.truncate()
-                in_code_block = False
-                marks_added = False
-                for line in lines:
-                    if line.strip().startswith("```"):
-                        in_code_block = not in_code_block
-                    if not in_code_block and line.startswith("#") and not marks_added:
-                        f.write(f"{line.rstrip()} ({total_marks} marks total)\n")
-                        marks_added = True
-                    else:
-                        f.write(line)
-
-        # create copy of document with answers removed
-        with open(markdown_file, "r") as f:
-            content = f.read()
-            lines = content.splitlines()
-            new_lines = []
-
-            i = 0
-            while i < len(lines):
-                line = lines[i]
-
-                # If this is an Answer heading, skip the answer content
-                if is_answer_heading(line):
-                    # Find the start of the next heading (or end of file)
-                    k = i + 1
-                    while k < len(lines) and not lines[k].lstrip().startswith("#"):
-                        k += 1
-
-                    # Within the answer block (i+1 .. k-1), identify the last
-                    # non-formatting line (i.e., not blank and not \\pagebreak).
-                    last_content_idx = None
-                    for idx in range(i + 1, k):
-                        if lines[idx].strip() not in ("", "\\pagebreak"):
-                            last_content_idx = idx
-
-                    if last_content_idx is None:
-                        # No real content (only blank/pagebreak lines) –
-                        # drop the Answer heading itself and keep all lines.
-                        for idx in range(i + 1, k):
-                            new_lines.append(lines[idx])
-                    else:
-                        # Drop the Answer heading and all answer-content lines
-                        # up to last_content_idx. Keep only trailing formatting
-                        # (blank lines and \\pagebreak) between the answer and
-                        # the next heading.
-                        for idx in range(last_content_idx + 1, k):
-                            new_lines.append(lines[idx])
-
-                    # Continue processing from the next heading (or EOF)
-                    i = k
-                    continue
-
-                # Not an Answer heading – keep the line
-                new_lines.append(line)
-                i += 1
-
-            new_content = "\n".join(new_lines)
-
-        with open(
-            os.path.join(markdown_output_folder, folder, "document_to_share.md"),
-            "w",
-        ) as f:
-            f.write(new_content)
-
-        # create separate markdown files for each question, with the answers included
-        with open(markdown_file, "r") as f:
-            content = f.read()
-            lines = content.splitlines()
-            new_lines = []
-            question_number = None
-            in_code_block = False
-            i = 0
-            while i < len(lines):
-                if lines[i].strip().startswith("```"):
-                    in_code_block = not in_code_block
-                if not in_code_block:
-                    match = re.match(r"^#+ Question (\d+)", lines[i], re.IGNORECASE)
-                    if match or i == len(lines):
-                        if question_number is not None:
-                            # Check if the last line is empty before adding a newline character
-                            new_content = "\n".join(new_lines)
-                            if new_content and not new_content.endswith("\n"):
-                                new_content += "\n"
-                            with open(
-                                os.path.join(
-                                    markdown_output_folder,
-                                    folder,
-                                    f"document_feedback_{question_number}.md",
-                                ),
-                                "w",
-                            ) as f:
-                                f.write(new_content)
-                            new_lines = []
-                        if match:
-                            question_number = match.group(1)
-                if question_number is not None:
-                    kind = classify_line(lines[i])
-
-                    # Stop at appendix heading
-                    if kind == "appendix":
-                        break
-
-                    # Stop at pagebreak followed by blank lines then an appendix
-                    if kind == "pagebreak":
-                        j = i + 1
-                        while j < len(lines) and classify_line(lines[j]) == "blank":
-                            j += 1
-                        if j < len(lines) and classify_line(lines[j]) == "appendix":
-                            break
-
-                    new_lines.append(lines[i])
-                i += 1
-            # Handle the last question
-            if new_lines:
-                new_content = "\n".join(new_lines)
-                if new_content and not new_content.endswith("\n"):
-                    new_content += "\n"
-                with open(
-                    os.path.join(
-                        markdown_output_folder,
-                        folder,
-                        f"document_feedback_{question_number}.md",
-                    ),
-                    "w",
-                ) as f:
-                    f.write(new_content)
-
-            # Rename the document.md file to document_instructor.md
-            os.rename(
-                markdown_file,
-                os.path.join(markdown_output_folder, folder, "document_instructor.md"),
-            )
+        if folder in feedback_folders and "document_instructor.md" in files:
+            with open(files["document_instructor.md"], "r") as f:
+                ast = json.load(f)
+            try:
+                feedback_asts = split_feedback_ast(ast)
+            except ValueError as e:
+                failures.append(
+                    ((folder, "feedback"), f"{folder}/document_feedback.pdf", str(e))
+                )
+                feedback_asts = {}
+            if feedback_asts and split_feedback:
+                # the instructor PDF is built, even if it is up to date, and
+                # split into the feedback PDFs
+                instructor_pdf = os.path.join(pdf_folder, "document_instructor.pdf")
+                unlink_hardlinked_file(instructor_pdf)
+                instructor_command = get_pdf_command(
+                    folder, files["document_instructor.md"], instructor_pdf
+                )
+                commands.append(
+                    (
+                        (folder, "pdf" if folder in pdf_folders else "feedback"),
+                        f"{folder}/document_instructor.pdf",
+                        functools.partial(
+                            build_feedback_pdfs,
+                            folder,
+                            instructor_command,
+                            instructor_pdf,
+                            feedback_asts,
+                            pdf_folder,
+                        ),
+                        None,
+                    )
+                )
+                sizes.append(os.path.getsize(files["document_instructor.md"]))
+                split_folders.append(folder)
+                outputs = [
+                    output for output in outputs if output[1] != "document_instructor.pdf"
+                ]
+                feedback_asts = {}
+            for question_number, feedback_ast in feedback_asts.items():
+                outputs.append(
+                    (
+                        "feedback",
+                        f"document_feedback_{question_number}.pdf",
+                        "-",
+                        json.dumps(feedback_ast),
+                    )
+                )
 
-            # Rename the document_to_share.md file to document.md
-            os.rename(
-                os.path.join(markdown_output_folder, folder, "document_to_share.md"),
-                markdown_file,
+        for artifact, file, ast_file, input_text in outputs:
+            pdf_file = os.path.join(pdf_folder, file)
+            unlink_hardlinked_file(pdf_file)
+            command = get_pdf_command(folder, ast_file, pdf_file)
+            commands.append(
+                ((folder, artifact), f"{folder}/{file}", command, input_text)
             )
-            license_markdown = get_license_as_markdown()
-            if license_markdown != "":
-                with open(markdown_file, "a") as f:
-                    f.write("\n" + license_markdown + "\n")
-
-
-def generate_assignment_pdfs(folders):
-    markdown_output_folder = config["project_markdown_output_folder"]
-    pdf_output_folder = config["project_pdf_output_folder"]
-    source_folder = config["project_source_folder"]
+            if input_text is None:
+                sizes.append(os.path.getsize(ast_file))
+            else:
+                sizes.append(len(input_text))
+
+    # every version of every assignment is a job of its own on the same pool,
+    # and the biggest start first
+    order = sorted(range(len(commands)), key=lambda i: sizes[i], reverse=True)
+    run_failures = run_commands([commands[i] for i in order], jobs)
+    # when the feedback PDFs are split from the instructor PDF, they fail
+    # with it
+    for (folder, artifact), label, reason in list(run_failures):
+        if folder in split_folders and artifact == "pdf":
+            run_failures.append(((folder, "feedback"), label, reason))
+    return failures + run_failures
+
+
+def generate_benchmark_markdown(markdown_folder, args):
+    # Writes the synthetic documents of a benchmark project to
+    # markdown_folder, ready to be imported, with their images in a
+    # <name>_includes folder next to each. The words are made up from a few
+    # syllables, from a generator seeded with the document number, so the
+    # same arguments always give the same documents. Returns the words used,
+    # for the spellchecker's dictionary.
+    syllables = ["ba", "ce", "di", "fo", "gu", "ka", "le", "mi", "no", "pu", "ra"]
+    rng = random.Random(0)
+    words = sorted(
+        {
+            "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+            for _ in range(400)
+        }
+    )
 
-    for folder in folders:
-        folder_path = os.path.join(markdown_output_folder, folder)
-        for file in os.listdir(folder_path):
-            if file.endswith(".md"):
-                markdown_file = os.path.join(folder_path, file)
-                pdf_folder = os.path.join(pdf_output_folder, folder)
-                os.makedirs(pdf_folder, exist_ok=True)
-                pdf_file = os.path.join(pdf_folder, file.replace(".md", ".pdf"))
-                settings_file = os.path.join(source_folder, folder, "settings.yaml")
-
-                command = ["pandoc", markdown_file, "-o", pdf_file]
-                if os.path.exists(settings_file):
-                    command.extend(["--metadata-file", settings_file])
-                if config.get("pandoc_pdf_engine"):
-                    command.extend(["--pdf-engine", config["pandoc_pdf_engine"]])
-                if config.get("project_pandoc_pdf_template"):
-                    command.extend(
-                        ["--template", config["project_pandoc_pdf_template"]]
-                    )
-                if config.get("pandoc_highlight_style"):
-                    command.extend(
-                        ["--highlight-style", config["pandoc_highlight_style"]]
-                    )
-                if config.get("project_pandoc_latex_header"):
-                    command.extend(["-H", config["project_pandoc_latex_header"]])
-                command.extend(
-                    ["--resource-path", os.path.join(markdown_output_folder, folder)]
+    def paragraph(rng):
+        sentences = []
+        for _ in range(rng.randint(3, 6)):
+            sentence = " ".join(rng.choice(words) for _ in range(rng.randint(8, 16)))
+            sentences.append(f"{sentence.capitalize()}.")
+        return " ".join(sentences)
+
+    for number in range(1, args.documents + 1):
+        rng = random.Random(number)
+        name = f"document_{number:03d}"
+        includes_folder = os.path.join(markdown_folder, f"{name}_includes")
+        os.makedirs(includes_folder, exist_ok=True)
+
+        body = []
+        for index in range(args.paragraphs):
+            if index % 8 == 0:
+                body.append(f"## {rng.choice(words).capitalize()} {rng.choice(words)}")
+            if index % 10 == 5:
+                body.append(
+                    "```bash\nfor file in *.txt; do\n  wc -l \"$file\"\ndone\n```"
+                )
+            body.append(paragraph(rng))
+        for image in range(1, args.images + 1):
+            image_file = f"figure_{image}.png"
+            with open(os.path.join(includes_folder, image_file), "wb") as f:
+                f.write(get_png_image(args.image_size, args.image_size, rng))
+            position = rng.randrange(len(body) + 1)
+            body.insert(position, f"![Figure {image}]({name}_includes/{image_file})")
+
+        if args.questions:
+            lines = [f"# Assignment {number}", "", paragraph(rng)]
+            per_question = max(1, len(body) // (args.questions * 2))
+            for question in range(1, args.questions + 1):
+                start = (question - 1) * per_question * 2
+                lines.extend(["", f"## Question {question}", "", "### 2 marks", ""])
+                lines.extend(body[start : start + per_question] or [paragraph(rng)])
+                lines.extend(["", "### Answer", ""])
+                lines.extend(
+                    body[start + per_question : start + per_question * 2]
+                    or [paragraph(rng)]
                 )
-                subprocess.run(command)
+                lines.extend(["", "\\pagebreak"])
+        else:
+            lines = [f"# Document {number}", ""] + body
+        with open(os.path.join(markdown_folder, f"{name}.md"), "w") as f:
+            f.write("\n\n".join(line for line in lines if line) + "\n")
+
+    return words
 
 
-def generate_htmls(folders):
+def generate_htmls(documents, jobs=1):
+    # documents maps each folder to the Markdown to render. The HTML is
+    # rendered from the same cached AST as the PDF, since the HTML writer
+    # leaves out the raw LaTeX page breaks.
     markdown_output_folder = config["project_markdown_output_folder"]
     html_output_folder = config["project_html_output_folder"]
-    source_folder = config["project_source_folder"]
 
-    for folder in folders:
-        markdown_file = os.path.join(markdown_output_folder, folder, "document.md")
+    ast_files, parse_failures = parse_documents(
+        {folder: {"document.md": content} for folder, content in documents.items()},
+        jobs,
+    )
+    failures = [
+        ((folder, "html"), label, reason)
+        for (folder, _), label, reason in parse_failures
+    ]
+
+    commands = []
+    for folder, files in ast_files.items():
         html_folder = os.path.join(html_output_folder, folder)
         os.makedirs(html_folder, exist_ok=True)
         html_file = os.path.join(html_folder, "document.html")
@@ -600,74 +1353,152 @@ def generate_htmls(folders):
         # Copy CSS file to styles folder
         styles_folder = os.path.join(html_folder, "styles")
         os.makedirs(styles_folder, exist_ok=True)
-        shutil.copy(config["project_pandoc_css_file"], styles_folder)
+        copy_file(
+            config["project_pandoc_css_file"],
+            os.path.join(
+                styles_folder, os.path.basename(config["project_pandoc_css_file"])
+            ),
+        )
 
         # Copy includes folder to HTML output folder
         includes_folder_source = os.path.join(
             markdown_output_folder, folder, "includes"
         )
         includes_folder_dest = os.path.join(html_folder, "includes")
-        if os.path.exists(includes_folder_dest):
-            shutil.rmtree(includes_folder_dest)
         if os.path.exists(includes_folder_source):
-            shutil.copytree(includes_folder_source, includes_folder_dest)
+            copy_tree(includes_folder_source, includes_folder_dest, delete=True)
+        elif os.path.exists(includes_folder_dest):
+            shutil.rmtree(includes_folder_dest)
 
-        # Specify the metadata file
-        settings_file = os.path.join(source_folder, folder, "settings.yaml")
+        unlink_hardlinked_file(html_file)
 
+        # the metadata from settings.yaml is already in the AST
         command = [
             "pandoc",
-            markdown_file,
+            "--from",
+            "json",
+            files["document.md"],
             "--standalone",
             "--css",
             os.path.join("styles", os.path.basename(config["project_pandoc_css_file"])),
-            "--metadata-file",
-            settings_file,
             "-o",
             html_file,
         ]
-        subprocess.run(command)
-
-
-def generate_markdown(folders):
-    markdown_output_folder = config["project_markdown_output_folder"]
+        commands.append(((folder, "html"), f"{folder}/document.html", command, None))
 
-    for folder in folders:
-        markdown_file = os.path.join(markdown_output_folder, folder, "document.md")
-
-        license_markdown = get_license_as_markdown()
-        if license_markdown != "":
-            with open(markdown_file, "a") as f:
-                f.write("\n" + license_markdown + "\n")
+    return failures + run_commands(commands, jobs)
 
 
-def generate_pdfs(folders):
-    markdown_output_folder = config["project_markdown_output_folder"]
+def generate_pdfs(documents, jobs=1):
+    # documents maps each folder to the Markdown to render
     pdf_output_folder = config["project_pdf_output_folder"]
-    source_folder = config["project_source_folder"]
 
-    for folder in folders:
-        markdown_file = os.path.join(markdown_output_folder, folder, "document.md")
+    ast_files, parse_failures = parse_documents(
+        {folder: {"document.md": content} for folder, content in documents.items()},
+        jobs,
+    )
+    failures = [
+        ((folder, "pdf"), label, reason)
+        for (folder, _), label, reason in parse_failures
+    ]
+
+    commands = []
+    for folder, files in ast_files.items():
         pdf_folder = os.path.join(pdf_output_folder, folder)
         os.makedirs(pdf_folder, exist_ok=True)
         pdf_file = os.path.join(pdf_folder, "document.pdf")
-        settings_file = os.path.join(source_folder, folder, "settings.yaml")
 
-        command = ["pandoc", markdown_file, "-o", pdf_file]
-        if os.path.exists(settings_file):
-            command.extend(["--metadata-file", settings_file])
-        if config.get("pandoc_pdf_engine"):
-            command.extend(["--pdf-engine", config["pandoc_pdf_engine"]])
-        if config.get("project_pandoc_pdf_template"):
-            command.extend(["--template", config["project_pandoc_pdf_template"]])
-        if config.get("pandoc_highlight_style"):
-            command.extend(["--highlight-style", config["pandoc_highlight_style"]])
-        if config.get("project_pandoc_latex_header"):
-            command.extend(["-H", config["project_pandoc_latex_header"]])
-        command.extend(
-            ["--resource-path", os.path.join(markdown_output_folder, folder)]
+        unlink_hardlinked_file(pdf_file)
+        command = get_pdf_command(folder, files["document.md"], pdf_file)
+        commands.append(((folder, "pdf"), f"{folder}/document.pdf", command, None))
+
+    return failures + run_commands(commands, jobs)
+
+
+def get_artifact_outputs(folder, artifact, assignment=False):
+    # The output files produced when building an artifact. The number of
+    # feedback PDFs depends on the document, so existing files are listed.
+    if artifact == "markdown":
+        return [
+            os.path.join(config["project_markdown_output_folder"], folder, "document.md")
+        ]
+    if artifact == "html":
+        return [os.path.join(config["project_html_output_folder"], folder, "document.html")]
+    if artifact == "data":
+        # folders without data files have no zip
+        zip_file = os.path.join(config["project_data_output_folder"], f"{folder}.zip")
+        return [zip_file] if get_data_files(folder) else []
+
+    pdf_folder = os.path.join(config["project_pdf_output_folder"], folder)
+    if artifact == "pdf" and not assignment:
+        return [os.path.join(pdf_folder, "document.pdf")]
+    if artifact == "pdf":
+        return [
+            os.path.join(pdf_folder, "document.pdf"),
+            os.path.join(pdf_folder, "document_instructor.pdf"),
+        ]
+    if not os.path.isdir(pdf_folder):
+        return []
+    return [
+        os.path.join(pdf_folder, file)
+        for file in sorted(os.listdir(pdf_folder))
+        if re.match(r"^document_feedback_\d+\.pdf$", file)
+    ]
+
+
+def get_command_output(command):
+    # Runs a command whose output doesn't change during a run, such as
+    # 'pandoc --version', once and returns its output ("" if it can't be run)
+    key = tuple(command)
+    if key not in command_outputs:
+        try:
+            command_outputs[key] = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+            ).stdout
+        except OSError:
+            command_outputs[key] = ""
+    return command_outputs[key]
+
+
+def get_data_file_hash(file_path, size, mtime_ns):
+    # The hash recorded in the build state is used if the file is unchanged
+    path = os.path.relpath(file_path, config["project_root"])
+    with build_state_lock:
+        row = build_state.execute(
+            "SELECT size, mtime_ns, hash FROM files WHERE path = ?", (path,)
+        ).fetchone()
+    if row is not None and row[:2] == (size, mtime_ns):
+        return row[2]
+    return hash_file(file_path)
+
+
+def get_data_files(folder_name):
+    # Returns the files to include in the data zip of a document folder, as a
+    # dictionary of paths relative to the zip folder and source paths. Files in
+    # data_not_tracked take precedence over files with the same path in data.
+    # Hidden files are skipped.
+    data_files = {}
+    for data_folder_name in ["data", "data_not_tracked"]:
+        source_data_folder = os.path.join(
+            config["project_source_folder"], folder_name, data_folder_name
         )
-        subprocess.run(command)
+        if not os.path.exists(source_data_folder):
+            continue
+        for item in sorted(os.listdir(source_data_folder)):
+            item_path = os.path.join(source_data_folder, item)
+            if item.startswith("."):
+                continue
+            if os.path.isfile(item_path):
+                data_files[item] = item_path
+                continue
+            for root, _, files in os.walk(item_path, followlinks=True):
+                for file in sorted(files):
+                    if not file.startswith("."):
+                        file_path = os.path.join(root, file)
+                        data_files[os.path.relpath(file_path, source_data_folder)] = (
+                            file_path
+                        )
+    return data_files
 
 
 def get_dropbox_client():
@@ -709,6 +1540,106 @@ def get_dropbox_client():
         sys.exit(1)
 
 
+def get_dropbox_content_hash(file_path):
+    # Computes the Dropbox content hash of a file: the SHA-256 of the
+    # concatenated SHA-256 hashes of each 4 MB block. Hashes are cached in the
+    # build state by size and modification time.
+    stat = os.stat(file_path)
+    path = os.path.abspath(file_path)
+    with build_state_lock:
+        row = build_state.execute(
+            "SELECT size, mtime_ns, hash FROM content_hashes WHERE path = ?", (path,)
+        ).fetchone()
+    if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+        return row[2]
+
+    block_hashes = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(4 * 1024 * 1024), b""):
+            block_hashes.update(hashlib.sha256(block).digest())
+    content_hash = block_hashes.hexdigest()
+
+    with build_state_lock, build_state:
+        build_state.execute(
+            """
+            INSERT OR REPLACE INTO content_hashes (path, size, mtime_ns, hash)
+            VALUES (?, ?, ?, ?)
+            """,
+            (path, stat.st_size, stat.st_mtime_ns, content_hash),
+        )
+    return content_hash
+
+
+def get_dropbox_folder_files(dbx, folder_path):
+    # Returns {lowercase file name: metadata} for the files in a Dropbox folder
+    files = {}
+    try:
+        result = dbx.files_list_folder(folder_path)
+    except dropbox.exceptions.ApiError as err:
+        if err.error.is_path() and err.error.get_path().is_not_found():
+            return files
+        raise
+    while True:
+        for entry in result.entries:
+            if isinstance(entry, dropbox.files.FileMetadata):
+                files[entry.name.lower()] = entry
+        if not result.has_more:
+            return files
+        result = dbx.files_list_folder_continue(result.cursor)
+
+
+def get_dropbox_shared_link(dbx, path):
+    # Creates a shareable link for path, or returns the existing one
+    try:
+        return dbx.sharing_create_shared_link_with_settings(path).url
+    except dropbox.exceptions.ApiError as err:
+        if "shared_link_already_exists" not in str(err):
+            raise
+    shared_links = dbx.sharing_list_shared_links(path=path, direct_only=True).links
+    if shared_links:
+        return shared_links[0].url
+    return None
+
+
+def get_dropbox_shared_links(dbx, folder_path):
+    # Returns {lowercase path: url} for the shared links to files in a
+    # Dropbox folder
+    prefix = folder_path.lower().rstrip("/") + "/"
+    links = {}
+    result = dbx.sharing_list_shared_links()
+    while True:
+        for link in result.links:
+            if link.path_lower and link.path_lower.startswith(prefix):
+                links.setdefault(link.path_lower, link.url)
+        if not result.has_more:
+            return links
+        result = dbx.sharing_list_shared_links(cursor=result.cursor)
+
+
+def get_folder_files(source_folder, relative_folder):
+    # Returns {path relative to the publish folder: source path} for every file
+    # in source_folder, placed under relative_folder
+    files = {}
+    for root, _, file_names in os.walk(source_folder):
+        for file_name in file_names:
+            file_path = os.path.join(root, file_name)
+            files[
+                os.path.join(relative_folder, os.path.relpath(file_path, source_folder))
+            ] = file_path
+    return files
+
+
+def get_folders_to_publish(publish_folder, kind, folders, changed_folders):
+    # Returns the folders whose outputs need publishing: those whose outputs
+    # changed in this run and those that have not been published yet
+    manifest = load_publish_manifest(publish_folder, kind)
+    return [
+        folder
+        for folder in folders
+        if folder in changed_folders or folder not in manifest
+    ]
+
+
 def get_folders_list(source_folder):
     return [
         name
@@ -717,6 +1648,204 @@ def get_folders_list(source_folder):
     ]
 
 
+def get_latex_format(lines):
+    # The lines at the start of a document's LaTeX that are the same as in
+    # the LaTeX of an empty document rendered with the same template are
+    # shared by every document, so they are precompiled with mylatexformat
+    # into a pdflatex format that is reused until they change. Formats can't
+    # be precompiled for xelatex or lualatex, since the fonts they load can't
+    # be saved in a format. Returns the name of the format and the number of
+    # lines it holds, or None if there is no format to use.
+    engine = config.get("pandoc_pdf_engine") or "pdflatex"
+    formats_folder = os.path.join(
+        config["project_build_cache_folder"], "latex", "formats"
+    )
+
+    with latex_format_lock:
+        if not get_command_output(["kpsewhich", "mylatexformat.ltx"]).strip():
+            return None
+        os.makedirs(formats_folder, exist_ok=True)
+
+        fingerprint = hashlib.sha256()
+        for part in [
+            get_command_output(["pandoc", "--version"]),
+            get_command_output([engine, "--version"]),
+            json.dumps(get_latex_options("")),
+        ]:
+            fingerprint.update(part.encode())
+            fingerprint.update(b"\0")
+        for key in ["project_pandoc_pdf_template", "project_pandoc_latex_header"]:
+            if config.get(key):
+                fingerprint.update(hash_file(config[key]).encode())
+
+        reference_file = os.path.join(
+            formats_folder, f"{fingerprint.hexdigest()}.reference.tex"
+        )
+        if not os.path.exists(reference_file):
+            command = [
+                "pandoc",
+                "--from",
+                "markdown",
+                "--to",
+                "latex-smart",
+                "--standalone",
+            ]
+            command.extend(get_latex_options(""))
+            command.extend(["-o", f"{reference_file}.tmp"])
+            result = subprocess.run(
+                command, input="", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            if result.returncode != 0:
+                return None
+            os.replace(f"{reference_file}.tmp", reference_file)
+        with open(reference_file, "r") as f:
+            reference_lines = f.read().splitlines(keepends=True)
+
+        # the format can only end between lines that are outside of any
+        # group or conditional. Commands that look like conditionals but
+        # aren't (e.g. \ifthenelse) only make the format shorter.
+        braces = 0
+        conditionals = 0
+        dumped_lines = 0
+        for i, (line, reference_line) in enumerate(zip(lines, reference_lines)):
+            if line != reference_line or line.startswith("\\begin{document}"):
+                break
+            code = re.sub(r"(?<!\\)%.*", "", line)
+            code = re.sub(r"\\newif\s*\\if[a-zA-Z@]*", "", code)
+            conditionals += len(re.findall(r"\\if[a-zA-Z@]*", code))
+            conditionals -= len(re.findall(r"\\fi(?![a-zA-Z@])", code))
+            code = re.sub(r"\\.", "", code)
+            braces += code.count("{") - code.count("}")
+            if braces == 0 and conditionals == 0:
+                dumped_lines = i + 1
+        if not any(
+            line.startswith("\\documentclass") for line in lines[:dumped_lines]
+        ):
+            return None
+
+        format_name = hashlib.sha256(
+            (fingerprint.hexdigest() + "".join(lines[:dumped_lines])).encode()
+        ).hexdigest()
+        format_file = os.path.join(formats_folder, f"{format_name}.fmt")
+        log_file = os.path.join(formats_folder, f"{format_name}.log")
+        if not os.path.exists(format_file):
+            # a format that failed to build is not tried again
+            if os.path.exists(log_file):
+                return None
+            with open(os.path.join(formats_folder, f"{format_name}.tex"), "w") as f:
+                f.write("".join(lines[:dumped_lines]))
+                f.write("\\endofdump\n\\begin{document}\n\\end{document}\n")
+            subprocess.run(
+                [
+                    engine,
+                    "-ini",
+                    "-interaction=nonstopmode",
+                    "-halt-on-error",
+                    f"-jobname={format_name}",
+                    f"&{engine}",
+                    "mylatexformat.ltx",
+                    f"{format_name}.tex",
+                ],
+                cwd=formats_folder,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            if not os.path.exists(format_file):
+                return None
+
+    return format_name, dumped_lines
+
+
+def get_latex_options(folder):
+    # The pandoc options for rendering a document's LaTeX
+    options = []
+    if config.get("project_pandoc_pdf_template"):
+        options.extend(["--template", config["project_pandoc_pdf_template"]])
+    if config.get("pandoc_highlight_style"):
+        options.extend(["--highlight-style", config["pandoc_highlight_style"]])
+    if config.get("project_pandoc_latex_header"):
+        options.extend(["-H", config["project_pandoc_latex_header"]])
+    if folder:
+        options.extend(
+            [
+                "--resource-path",
+                os.path.join(config["project_markdown_output_folder"], folder),
+            ]
+        )
+    return options
+
+
+def get_markdown_links(content):
+    # Returns the distinct link targets in Markdown content, in order: inline
+    # links and images, reference definitions, autolinks and bare URLs.
+    # Fenced code blocks and code spans are skipped.
+    links = []
+    in_code_block = False
+    for line in content.splitlines():
+        if line.strip().startswith(("```", "~~~")):
+            in_code_block = not in_code_block
+            continue
+        if in_code_block:
+            continue
+        line = re.sub(r"`+[^`]*`+", "", line)
+        for pattern in [
+            r"\]\(\s*<?((?:[^()\s<>]|\([^()\s]*\))+)>?",
+            r"^\s{0,3}\[[^\]]+\]:\s*<?([^\s>]+)>?",
+            r"<(https?://[^>\s]+)>",
+        ]:
+            links.extend(re.findall(pattern, line))
+            line = re.sub(pattern, " ", line)
+        links.extend(
+            url.rstrip(".,;:!?'\"")
+            for url in re.findall(r"https?://[^\s<>()\[\]`]+", line)
+        )
+    return list(dict.fromkeys(links))
+
+
+def get_lint_line_file(line, files):
+    # Returns the file whose output a line of lint tool output starts, if
+    # any (see run_lint_tool)
+    for file in files:
+        for prefix in ["", "FILE: "]:
+            if line.startswith(prefix + file) and line[len(prefix + file) :][
+                :1
+            ] in ["", ":", " "]:
+                return file
+    return None
+
+
+def get_lint_tool_settings(command):
+    # The files whose content affects the output of an external lint tool,
+    # for the lint cache: its config files, the files they name (such as an
+    # mdl style or the dictionaries of the spellchecker) and the files given
+    # in its command. Returns the path and hash of each.
+    config_files = []
+    for name in lint_tool_config_files.get(os.path.basename(command[0]), []):
+        folder = os.getcwd()
+        while not os.path.isfile(os.path.join(folder, name)):
+            if os.path.dirname(folder) == folder:
+                folder = os.path.expanduser("~")
+                break
+            folder = os.path.dirname(folder)
+        if os.path.isfile(os.path.join(folder, name)):
+            config_files.append(os.path.join(folder, name))
+
+    setting_files = [argument for argument in command[1:] if os.path.isfile(argument)]
+    for config_file in config_files:
+        setting_files.append(config_file)
+        with open(config_file, "r", errors="replace") as f:
+            words = re.findall(r"[^\s\"',:=\[\]{}]+", f.read())
+        for word in words:
+            for folder in [os.path.dirname(config_file), os.getcwd()]:
+                file_path = os.path.join(folder, os.path.expanduser(word))
+                if os.path.isfile(file_path):
+                    setting_files.append(file_path)
+                    break
+
+    return [[file_path, hash_file(file_path)] for file_path in setting_files]
+
+
 def get_license_as_markdown():
     license_link_text = config.get("license_link_text")
     license_link_url = config.get("license_link_url")
@@ -731,131 +1860,281 @@ def get_license_as_markdown():
         return ""
 
 
-def get_modified_data_folders(folders):
-    build_logs_folder = config["project_build_logs_folder"]
-    project_source_folder = config["project_source_folder"]
-    modified_folders = []
+def get_artifact_fingerprints(folders, assignment=False):
+    # The fingerprint of an artifact is a hash of every input that affects it,
+    # as listed in artifact_inputs
+    include_hashes = {}
+    for key in ["project_pandoc_pdf_template", "project_pandoc_latex_header", "project_pandoc_css_file"]:
+        if config.get(key) and os.path.isfile(config[key]):
+            include_hashes[key] = hash_file(config[key])
 
-    for folder in folders:
-        folder_log_folder = os.path.join(build_logs_folder, folder)
-        timestamp_file = os.path.join(folder_log_folder, "timestamp.txt")
-        file_list_file = os.path.join(folder_log_folder, "file_list.txt")
+    files = {}
+    for folder, kind, path, file_hash in build_state.execute(
+        "SELECT folder, kind, path, hash FROM files ORDER BY path"
+    ):
+        files.setdefault((folder, kind), []).append((path, file_hash))
 
-        # If timestamp or file_list.txt is missing, consider the folder modified
-        if not os.path.exists(timestamp_file) or not os.path.exists(file_list_file):
-            modified_folders.append(folder)
-            continue
+    fingerprints = {}
+    for folder in folders:
+        for artifact, inputs in artifact_inputs.items():
+            fingerprint = {
+                "assignment": assignment,
+                "config": {key: config.get(key) for key in inputs["config"]},
+                "files": [
+                    entry
+                    for kind in inputs["files"]
+                    for entry in files.get((folder, kind), [])
+                ],
+                "includes": {
+                    key: include_hashes.get(key) for key in inputs["includes"]
+                },
+            }
+            # the instructor version of an assignment depends on how its
+            # feedback PDFs are built (see generate_assignment_markdown)
+            if assignment and artifact == "pdf":
+                fingerprint["config"]["feedback_pdf_mode"] = config.get(
+                    "feedback_pdf_mode"
+                )
+            fingerprints[(folder, artifact)] = hashlib.sha256(
+                json.dumps(fingerprint, sort_keys=True).encode()
+            ).hexdigest()
 
-        # Read the timestamp
-        with open(timestamp_file, "r") as f:
-            timestamp = float(f.read())
-
-        # Read the previous file list and filter data files
-        with open(file_list_file, "r") as f:
-            all_previous_files = set(os.path.normpath(line.strip()) for line in f)
-
-        # Filter previous files to include only data files, ignoring hidden files
-        previous_data_files = set()
-        for file_path in all_previous_files:
-            if file_path.startswith(
-                os.path.join(folder, "data")
-            ) or file_path.startswith(os.path.join(folder, "data_not_tracked")):
-                if not os.path.basename(file_path).startswith("."):  # Skip hidden files
-                    previous_data_files.add(file_path)
-
-        # Collect current data files
-        current_data_files = set()
-        folder_modified = False
-
-        source_folder = os.path.join(project_source_folder, folder)
-
-        for subfolder in ["data", "data_not_tracked"]:
-            data_folder = os.path.join(source_folder, subfolder)
-            if os.path.exists(data_folder):
-                for root, _, files in os.walk(data_folder):
-                    for file in files:
-                        if file.startswith("."):
-                            continue  # Skip hidden files
-                        file_path = os.path.join(root, file)
-                        relative_path = os.path.normpath(
-                            os.path.relpath(file_path, start=project_source_folder)
-                        )
-                        current_data_files.add(relative_path)
+    return fingerprints
 
-                        # Check if the file was modified after the last timestamp
-                        if os.path.getmtime(file_path) > timestamp:
-                            folder_modified = True
 
-        # Compare the current and previous data files
-        if current_data_files != previous_data_files or folder_modified:
-            modified_folders.append(folder)
+def get_pdf_command(folder, ast_file, pdf_file):
+    # The command rendering the AST in ast_file ("-" for stdin) to pdf_file,
+    # for run_commands. The metadata from settings.yaml is already in the AST.
+    if config.get("pdf_build_mode") == "cached" and (
+        config.get("pandoc_pdf_engine") or "pdflatex"
+    ) in latex_engines:
+        return lambda input_text: build_cached_pdf(
+            folder, ast_file, pdf_file, input_text
+        )
 
-    return modified_folders
+    command = ["pandoc", "--from", "json", ast_file, "-o", pdf_file]
+    if config.get("pandoc_pdf_engine"):
+        command.extend(["--pdf-engine", config["pandoc_pdf_engine"]])
+    command.extend(get_latex_options(folder))
+    return command
 
 
-def get_modified_folders(folders):
-    build_logs_folder = config["project_build_logs_folder"]
-    data_to_share_links_folder = config["project_data_to_share_links_folder"]
-    project_source_folder = config["project_source_folder"]
-    modified_folders = []
+def get_png_image(width, height, rng):
+    # Returns a PNG image of random pixels, made with rng
+    rows = b"".join(
+        b"\0" + bytes(rng.getrandbits(8) for _ in range(width * 3))
+        for _ in range(height)
+    )
 
-    for folder in folders:
-        folder_log_folder = os.path.join(build_logs_folder, folder)
-        timestamp_file = os.path.join(folder_log_folder, "timestamp.txt")
-        file_list_file = os.path.join(folder_log_folder, "file_list.txt")
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
 
-        # If timestamp or file list is missing, consider the folder modified
-        if not os.path.exists(timestamp_file) or not os.path.exists(file_list_file):
-            modified_folders.append(folder)
-            continue
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
 
-        # Read the timestamp
-        with open(timestamp_file, "r") as f:
-            timestamp = float(f.read())
 
-        # Read the previous file list, ignoring hidden files
-        with open(file_list_file, "r") as f:
-            previous_files = set(
-                os.path.normpath(line.strip())
+def get_spellchecker_fingerprint():
+    # Returns a hash of the spellchecker's dictionary (with the .aff file of
+    # a Hunspell dictionary), and a hash of the dictionary and the project's
+    # word list, which changes when either does
+    dictionary = config["spellchecker_dictionary"]
+    dictionary_files = [dictionary]
+    if dictionary.endswith(".dic"):
+        aff_file = f"{dictionary[:-4]}.aff"
+        if os.path.exists(aff_file):
+            dictionary_files.append(aff_file)
+    dictionary_hash = hashlib.sha256()
+    for file_path in dictionary_files:
+        with open(file_path, "rb") as f:
+            dictionary_hash.update(f.read())
+    dictionary_hash = dictionary_hash.hexdigest()
+
+    word_list = ""
+    word_list_file = config.get("project_spellchecker_words")
+    if word_list_file and os.path.exists(word_list_file):
+        with open(word_list_file, "r", encoding="utf-8") as f:
+            word_list = f.read()
+
+    fingerprint = hashlib.sha256(
+        f"{dictionary_hash}\n{word_list}".encode("utf-8")
+    ).hexdigest()
+    return dictionary_hash, fingerprint
+
+
+def get_spellchecker_words():
+    # Loads the dictionary (spellchecker_dictionary) and the project's word
+    # list (project_spellchecker_words) into a set. The dictionary is either
+    # a list of words, one per line, or a Hunspell .dic file, whose words are
+    # expanded with the affixes in the .aff file next to it once and then
+    # stored in the build cache. Returns the set and the fingerprint of the
+    # dictionary and word list (see get_spellchecker_fingerprint).
+    dictionary = config["spellchecker_dictionary"]
+    dictionary_hash, fingerprint = get_spellchecker_fingerprint()
+
+    if dictionary.endswith(".dic"):
+        cache_file = os.path.join(
+            config["project_build_cache_folder"],
+            "spellchecker",
+            f"{dictionary_hash}.txt",
+        )
+        if os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as f:
+                words = set(f.read().splitlines())
+        else:
+            words = load_hunspell_words(dictionary)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(f"{cache_file}.tmp", "w", encoding="utf-8") as f:
+                f.write("".join(f"{word}\n" for word in sorted(words)))
+            os.replace(f"{cache_file}.tmp", cache_file)
+    else:
+        with open(dictionary, "r", encoding="utf-8", errors="replace") as f:
+            words = {line.strip() for line in f if line.strip()}
+
+    word_list_file = config.get("project_spellchecker_words")
+    if word_list_file and os.path.exists(word_list_file):
+        with open(word_list_file, "r", encoding="utf-8") as f:
+            words.update(
+                line.strip()
                 for line in f
-                if not os.path.basename(line.strip()).startswith(".")
+                if line.strip() and not line.lstrip().startswith("#")
             )
+    return words, fingerprint
 
-        current_files = set()
-        folder_modified = False
 
-        # Collect current files using the same base directory, skipping hidden files
-        for root, _, files in os.walk(os.path.join(project_source_folder, folder)):
-            for file in files:
-                if file.startswith("."):
-                    continue  # Skip hidden files
-                file_path = os.path.join(root, file)
-                relative_path = os.path.normpath(
-                    os.path.relpath(file_path, start=project_source_folder)
-                )
-                current_files.add(relative_path)
-
-                # Check if the file was modified after the last timestamp
-                file_mod_time = os.path.getmtime(file_path)
-                if file_mod_time > timestamp:
-                    folder_modified = True
-
-        # Include data_to_share_links_file, skipping hidden files
-        data_link_file = os.path.join(data_to_share_links_folder, f"{folder}.txt")
-        if os.path.exists(data_link_file):
-            if not os.path.basename(data_link_file).startswith("."):
-                relative_path = os.path.normpath(
-                    os.path.relpath(data_link_file, start=project_source_folder)
+def get_stale_folders(folders, artifact, fingerprints):
+    # An artifact is stale when its inputs have changed since it was last
+    # built, or when one of the outputs it produced is missing
+    project_root = config["project_root"]
+    recorded = dict(
+        build_state.execute(
+            "SELECT folder, fingerprint FROM artifacts WHERE artifact = ?",
+            (artifact,),
+        )
+    )
+    missing_outputs = set(
+        folder
+        for folder, path in build_state.execute(
+            "SELECT folder, path FROM outputs WHERE artifact = ?", (artifact,)
+        )
+        if not os.path.exists(os.path.join(project_root, path))
+    )
+    return [
+        folder
+        for folder in folders
+        if recorded.get(folder) != fingerprints[(folder, artifact)]
+        or folder in missing_outputs
+    ]
+
+
+def get_table_of_contents(folders, extension):
+    # Returns the table of contents of the published documents, linking to
+    # their .md or .html versions
+    include_pdfs_with_markdown_and_html = config.get(
+        "include_pdfs_with_markdown_and_html", False
+    )
+    markdown_output_folder = config["project_markdown_output_folder"]
+    document_order = config.get("toc_order", [])
+    document_heading = config.get("toc_heading", "")
+
+    contents = []
+    if document_heading:
+        contents.append(f"# {document_heading}\n")
+
+    folders = list(folders)
+    if document_order:
+        folders.sort(
+            key=lambda folder: (
+                document_order.index(folder)
+                if folder in document_order
+                else float("inf")
+            )
+        )
+    else:
+        folders.sort(key=str.lower)
+
+    disallowed_names = ["styles", "index.html", "index.md", "README.md", "pdf"]
+    for folder_name in folders:
+        source_markdown_folder = os.path.join(markdown_output_folder, folder_name)
+        if folder_name in disallowed_names or not os.path.isdir(source_markdown_folder):
+            continue
+        for file_name in sorted(os.listdir(source_markdown_folder)):
+            if file_name.endswith(".md"):
+                formatted_folder_name = folder_name.replace("_", " ")
+                file_name_without_ext, _ = os.path.splitext(file_name)
+                document_link = os.path.join(
+                    folder_name, file_name_without_ext + extension
                 )
-                current_files.add(relative_path)
-                if os.path.getmtime(data_link_file) > timestamp:
-                    folder_modified = True
+                if include_pdfs_with_markdown_and_html:
+                    contents.append(
+                        f"- [{formatted_folder_name}]({document_link}) | [PDF]({os.path.join(folder_name, 'includes', file_name_without_ext + '.pdf')})"
+                    )
+                else:
+                    contents.append(f"- [{formatted_folder_name}]({document_link})")
 
-        # Compare the current and previous file lists
-        if current_files != previous_files or folder_modified:
-            modified_folders.append(folder)
+    license_markdown = get_license_as_markdown()
+    table_of_contents = "\n".join(contents) + "\n"
+    if license_markdown != "":
+        table_of_contents += "\n" + license_markdown + "\n"
+    return table_of_contents
+
+
+def get_tracked_files(folder):
+    # Yields (path, kind) for every file that affects the documents built from
+    # folder. Hidden files are skipped.
+    project_source_folder = config["project_source_folder"]
+    data_to_share_links_folder = config["project_data_to_share_links_folder"]
+
+    for root, dirs, files in os.walk(os.path.join(project_source_folder, folder)):
+        dirs.sort()
+        relative_root = os.path.relpath(root, project_source_folder)
+        parts = relative_root.split(os.sep)
+        if len(parts) > 1 and parts[1] in ["data", "data_not_tracked"]:
+            kind = "data"
+        else:
+            kind = "document"
+        for file in sorted(files):
+            if not file.startswith("."):
+                if len(parts) == 1 and file == "settings.yaml":
+                    yield os.path.join(root, file), "settings"
+                else:
+                    yield os.path.join(root, file), kind
 
-    return modified_folders
+    data_link_file = os.path.join(data_to_share_links_folder, f"{folder}.txt")
+    if os.path.exists(data_link_file):
+        yield data_link_file, "link"
+
+
+def get_zip_header_fields(zinfo):
+    # Returns the encoded file name, general purpose flags, and MS-DOS time
+    # and date of a member. Names that are not ASCII are encoded as UTF-8,
+    # which is marked by flag bit 11.
+    try:
+        filename = zinfo.filename.encode("ascii")
+        flag_bits = 0
+    except UnicodeEncodeError:
+        filename = zinfo.filename.encode("utf-8")
+        flag_bits = 0x800
+    year, month, day, hour, minute, second = zinfo.date_time
+    dos_time = hour << 11 | minute << 5 | second // 2
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    return filename, flag_bits, dos_time, dos_date
+
+
+def hash_file(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
 
 
 def import_markdown_files(source):
@@ -1030,6 +2309,261 @@ def load_config(config_file_path):
         config = {}
 
 
+def load_build_state():
+    # The build state records the size, modification time and content hash of
+    # every tracked file as of the start of the current run (files), and the
+    # fingerprint of the inputs of each artifact when it was last built
+    # (artifacts) along with the output files it produced (outputs). The
+    # Dropbox content hashes of published data files are cached in
+    # content_hashes, and the Dropbox upload sessions of large data files are
+    # recorded in upload_sessions so that interrupted uploads can be resumed.
+    # Uploads run in several threads, so access is guarded by
+    # build_state_lock.
+    global build_state, build_state_lock
+    build_state = sqlite3.connect(
+        os.path.join(config["project_build_logs_folder"], "build_state.sqlite3"),
+        check_same_thread=False,
+    )
+    build_state_lock = threading.Lock()
+    with build_state:
+        build_state.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+            CREATE TABLE IF NOT EXISTS artifacts (
+                folder TEXT NOT NULL,
+                artifact TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                PRIMARY KEY (folder, artifact)
+            );
+            CREATE TABLE IF NOT EXISTS content_hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outputs (
+                folder TEXT NOT NULL,
+                artifact TEXT NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (folder, artifact, path)
+            );
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                path TEXT PRIMARY KEY,
+                destination TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                offset INTEGER NOT NULL
+            );
+            """
+        )
+
+
+def load_publish_manifest(publish_folder, kind):
+    # The manifest maps each document folder to the files published for it
+    # (see sync_publish_folder)
+    manifest_file = os.path.join(publish_folder, f".document-builder-{kind}.json")
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file, "r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            pass
+    return {}
+
+
+def load_markdown_documents(folders):
+    source_folder = config["project_source_folder"]
+
+    documents = {}
+    for folder in folders:
+        with open(os.path.join(source_folder, folder, "document.md"), "r") as f:
+            documents[folder] = f.read()
+    return documents
+
+
+def load_hunspell_words(dic_file):
+    # Returns all the words of a Hunspell dictionary: each word of the .dic
+    # file and the forms made by the prefixes and suffixes of its flags (and
+    # both, for affixes that allow it), as defined in the .aff file next to
+    # it. Compounding and the other options of Hunspell are not supported.
+    aff_file = f"{dic_file[:-4]}.aff"
+    encoding = "utf-8"
+    flag_type = "char"
+    affixes = {}
+    if os.path.exists(aff_file):
+        with open(aff_file, "r", encoding="latin-1") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) > 1 and parts[0] == "SET":
+                    encoding = parts[1]
+                    break
+        with open(aff_file, "r", encoding=encoding, errors="replace") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) > 1 and parts[0] == "FLAG":
+                    flag_type = parts[1]
+                elif len(parts) >= 4 and parts[0] in ("PFX", "SFX"):
+                    if parts[1] not in affixes:
+                        affixes[parts[1]] = (parts[0], parts[2] == "Y", [])
+                        continue
+                    strip = "" if parts[2] == "0" else parts[2]
+                    add = parts[3].split("/")[0]
+                    add = "" if add == "0" else add
+                    condition = parts[4] if len(parts) > 4 else "."
+                    try:
+                        if parts[0] == "PFX":
+                            condition = re.compile(f"^(?:{condition})")
+                        else:
+                            condition = re.compile(f"(?:{condition})$")
+                    except re.error:
+                        continue
+                    affixes[parts[1]][2].append((strip, add, condition))
+
+    words = set()
+    with open(dic_file, "r", encoding=encoding, errors="replace") as f:
+        # the first line is the number of words
+        f.readline()
+        for line in f:
+            if not line.strip():
+                continue
+            word, _, flags = line.split()[0].partition("/")
+            words.add(word)
+            if flag_type == "long":
+                flags = [flags[i : i + 2] for i in range(0, len(flags), 2)]
+            elif flag_type == "num":
+                flags = flags.split(",")
+
+            prefixes = []
+            suffixed = []
+            for flag in flags:
+                if flag not in affixes:
+                    continue
+                kind, cross, rules = affixes[flag]
+                for strip, add, condition in rules:
+                    if not condition.search(word):
+                        continue
+                    if kind == "PFX" and word.startswith(strip):
+                        words.add(add + word[len(strip) :])
+                        if cross:
+                            prefixes.append((strip, add))
+                    elif kind == "SFX" and word.endswith(strip):
+                        form = word[: len(word) - len(strip)] + add
+                        words.add(form)
+                        if cross:
+                            suffixed.append(form)
+            for strip, add in prefixes:
+                for form in suffixed:
+                    if form.startswith(strip):
+                        words.add(add + form[len(strip) :])
+    return words
+
+
+def parse_assignment_markdown(content):
+    # Parses the Markdown of an assignment into a model of its headings, in
+    # one pass over its lines. Lines in fenced code blocks are never headings
+    # or page breaks. Returns a dict holding "lines", the lines of content;
+    # "headings", a (line index, kind, value) tuple for each heading, where
+    # kind is the group of assignment_heading that matched, with the
+    # question number or marks as value, or "heading" for other headings;
+    # and "end", the index of the line where the questions end: the first
+    # appendix heading after a question, or the page break before it if
+    # only blank lines are between them.
+    lines = content.splitlines()
+    headings = []
+    end = len(lines)
+    in_code_block = False
+    seen_question = False
+    pagebreak = None
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            in_code_block = not in_code_block
+        elif in_code_block or not stripped:
+            continue
+        elif is_pagebreak(stripped):
+            pagebreak = index
+            continue
+        elif stripped.startswith("#"):
+            match = assignment_heading.match(stripped)
+            if match:
+                headings.append((index, match.lastgroup, match.group(match.lastgroup)))
+            else:
+                headings.append((index, "heading", None))
+            if headings[-1][1] == "question":
+                seen_question = True
+            elif headings[-1][1] == "appendix" and seen_question and end == len(lines):
+                end = index if pagebreak is None else pagebreak
+        pagebreak = None
+
+    return {"lines": lines, "headings": headings, "end": end}
+
+
+def parse_documents(documents, jobs=1):
+    # documents maps each folder to a dict of {file name: Markdown}. Each
+    # document is parsed by pandoc into its JSON AST, with the metadata from
+    # the folder's settings.yaml, and cached in the build cache folder under
+    # the hash of everything that affects the parse, so that a document is
+    # only parsed again when it changes. Returns a dict mapping each folder
+    # to a dict of {file name: AST file}, holding the documents that were
+    # parsed, and the failures, as returned by run_commands.
+    source_folder = config["project_source_folder"]
+    ast_folder = os.path.join(config["project_build_cache_folder"], "ast")
+    os.makedirs(ast_folder, exist_ok=True)
+
+    ast_files = {}
+    parsing = set()
+    commands = []
+    for folder, files in documents.items():
+        settings_file = os.path.join(source_folder, folder, "settings.yaml")
+        settings_hash = ""
+        if os.path.exists(settings_file):
+            settings_hash = hash_file(settings_file)
+        for file, content in files.items():
+            key = hashlib.sha256()
+            for part in [get_command_output(["pandoc", "--version"]), settings_hash, content]:
+                key.update(part.encode())
+                key.update(b"\0")
+            ast_file = os.path.join(ast_folder, f"{key.hexdigest()}.json")
+            ast_files.setdefault(folder, {})[file] = ast_file
+            if os.path.exists(ast_file) or ast_file in parsing:
+                continue
+
+            parsing.add(ast_file)
+            command = ["pandoc", "--from", "markdown", "--to", "json"]
+            if os.path.exists(settings_file):
+                command.extend(["--metadata-file", settings_file])
+            command.extend(["-o", f"{ast_file}.tmp"])
+            commands.append(((folder, file), f"{folder}/{file}", command, content))
+
+    # the longest documents are parsed first, so that the last to finish
+    # isn't a long one started when the others were nearly done
+    commands.sort(key=lambda command: len(command[3]), reverse=True)
+    failures = run_commands(commands, jobs)
+    failed = set(failure[0] for failure in failures)
+    for key, _, command, _ in commands:
+        temporary_file = command[-1]
+        if key not in failed:
+            os.replace(temporary_file, temporary_file[: -len(".tmp")])
+        elif os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+    # documents whose parse failed are left out
+    parsed = {}
+    for folder, files in ast_files.items():
+        for file, ast_file in files.items():
+            if os.path.exists(ast_file):
+                parsed.setdefault(folder, {})[file] = ast_file
+    return parsed, failures
+
+
 def pretty_print(message, verbose=False):
     if verbose:
         print(f"\033[92m{message}\033[0m")  # Green text
@@ -1043,6 +2577,11 @@ def pretty_print_error(message):
     print(f"\033[91m{message}\033[0m")  # Red text
 
 
+def print_transform_timings(verbose=False):
+    for name, seconds in transform_timings.items():
+        pretty_print(f"  {name}: {seconds:.3f}s", verbose)
+
+
 def prompt_yes_no(message, default=None):
     valid_responses = {"yes": True, "y": True, "no": False, "n": False}
     default_str = (
@@ -1060,34 +2599,31 @@ def prompt_yes_no(message, default=None):
             print("Please respond with 'yes' or 'no' (or 'y' or 'n').")
 
 
-def publish_assignment_pdfs():
+def publish_assignment_pdfs(folders, changed_folders):
     pdf_output_folder = config["project_pdf_output_folder"]
     publish_folder_pdf = config["publish_folder_pdf"]
 
     if not publish_folder_pdf or not os.path.exists(publish_folder_pdf):
         return  # Do nothing if path is empty or doesn't exist
 
-    os.makedirs(
-        publish_folder_pdf, exist_ok=True
-    )  # Create the directory if it doesn't exist
-
-    for folder_name in os.listdir(pdf_output_folder):
+    files = {}
+    for folder_name in get_folders_to_publish(
+        publish_folder_pdf, "pdf", folders, changed_folders
+    ):
+        files[folder_name] = {}
         source_pdf_folder = os.path.join(pdf_output_folder, folder_name)
         if os.path.isdir(source_pdf_folder):
             for file_name in os.listdir(source_pdf_folder):
                 if file_name.endswith(".pdf"):
-                    source_pdf_file = os.path.join(source_pdf_folder, file_name)
                     new_file_name = file_name.replace("document", folder_name)
-                    destination_pdf_file = os.path.join(
-                        publish_folder_pdf, new_file_name
+                    files[folder_name][new_file_name] = os.path.join(
+                        source_pdf_folder, file_name
                     )
-                    if not os.path.exists(destination_pdf_file) or not filecmp.cmp(
-                        source_pdf_file, destination_pdf_file, shallow=False
-                    ):
-                        shutil.copy2(source_pdf_file, destination_pdf_file)
 
+    sync_publish_folder(publish_folder_pdf, "pdf", folders, files)
 
-def publish_data():
+
+def publish_data(folders, changed_folders):
     data_output_folder = config["project_data_output_folder"]
     publish_folder_data = config["publish_folder_data"]
     data_to_share_links_folder = config["project_data_to_share_links_folder"]
@@ -1095,32 +2631,29 @@ def publish_data():
     if not publish_folder_data or not os.path.exists(publish_folder_data):
         return  # Do nothing if path is empty or doesn't exist
 
-    os.makedirs(
-        publish_folder_data, exist_ok=True
-    )  # Create the directory if it doesn't exist
+    files = {}
+    for folder_name in get_folders_to_publish(
+        publish_folder_data, "data", folders, changed_folders
+    ):
+        files[folder_name] = {}
+        source_data_file = os.path.join(data_output_folder, f"{folder_name}.zip")
+        if os.path.exists(source_data_file):
+            files[folder_name][f"{folder_name}.zip"] = source_data_file
 
-    for file_name in os.listdir(data_output_folder):
-        if file_name.endswith((".zip")):
-            source_data_file = os.path.join(data_output_folder, file_name)
-            destination_data_file = os.path.join(publish_folder_data, file_name)
-            if not os.path.exists(destination_data_file) or not filecmp.cmp(
-                source_data_file, destination_data_file, shallow=False
-            ):
-                shutil.copy2(source_data_file, destination_data_file)
-                file_name_without_extension, _ = os.path.splitext(file_name)
-                new_file_name = f"{file_name_without_extension}.txt"
-                new_file_path = os.path.join(data_to_share_links_folder, new_file_name)
-                print(
-                    f"\033[95mNew data file generated, add sharable link to\033[94m {new_file_path}\033[0m"
-                )
+    for file_name in sync_publish_folder(publish_folder_data, "data", folders, files):
+        file_name_without_extension, _ = os.path.splitext(file_name)
+        new_file_name = f"{file_name_without_extension}.txt"
+        new_file_path = os.path.join(data_to_share_links_folder, new_file_name)
+        print(
+            f"\033[95mNew data file generated, add sharable link to\033[94m {new_file_path}\033[0m"
+        )
 
 
-def publish_htmls():
+def publish_htmls(folders, changed_folders):
     pdf_output_folder = config["project_pdf_output_folder"]
     include_pdfs_with_markdown_and_html = config.get(
         "include_pdfs_with_markdown_and_html", False
     )
-    publish_folder_markdown = config["publish_folder_markdown"]
     html_output_folder = config["project_html_output_folder"]
     publish_folder_html = config["publish_folder_html"]
     document_author = config.get("toc_author", "")
@@ -1129,82 +2662,83 @@ def publish_htmls():
     if not publish_folder_html or not os.path.exists(publish_folder_html):
         return  # Do nothing if path is empty or doesn't exist
 
-    os.makedirs(publish_folder_html, exist_ok=True)
-
+    # the index is generated in the HTML output folder, and only when the
+    # table of contents or the way it is rendered has changed
     pandoc_css_file = config.get("project_pandoc_css_file", "")
-    styles_folder = os.path.join(publish_folder_html, "styles")
-    os.makedirs(styles_folder, exist_ok=True)
-    shutil.copy2(pandoc_css_file, styles_folder)
+    index_markdown_file = os.path.join(html_output_folder, "index.md")
+    index_html_file = os.path.join(html_output_folder, "index.html")
+
+    command = [
+        "pandoc",
+        index_markdown_file,
+        "--standalone",
+        "--css",
+        os.path.join("styles", os.path.basename(pandoc_css_file)),
+    ]
+
+    if document_author:
+        command.extend(["-M", f"author={document_author}"])
+    if document_title:
+        command.extend(["-M", f"title={document_title}"])
 
-    folders = os.listdir(html_output_folder)
+    command.append("-o")
+    command.append(index_html_file)
+
+    index_changed = write_file_if_changed(
+        index_markdown_file, get_table_of_contents(folders, ".html")
+    )
+    command_changed = write_file_if_changed(
+        os.path.join(html_output_folder, "index_command.json"), json.dumps(command)
+    )
+    if index_changed or command_changed or not os.path.exists(index_html_file):
+        subprocess.run(command)
+
+    # files shared by all documents are published under the "" folder
+    files = {
+        "": {
+            os.path.join("styles", os.path.basename(pandoc_css_file)): pandoc_css_file,
+        }
+    }
+    if os.path.exists(index_html_file):
+        files[""]["index.html"] = index_html_file
 
     disallowed_names = ["styles", "index.html", "index.md", "README.md", "pdf"]
-    for folder_name in folders:
+    for folder_name in get_folders_to_publish(
+        publish_folder_html, "html", folders, changed_folders
+    ):
         if folder_name in disallowed_names:
             pretty_print_error(f"Skipping document called '{folder_name}'")
             continue
 
+        files[folder_name] = {}
         source_html_folder = os.path.join(html_output_folder, folder_name)
         if os.path.isdir(source_html_folder):
-            destination_html_folder = os.path.join(publish_folder_html, folder_name)
-            os.makedirs(destination_html_folder, exist_ok=True)
             for file_name in os.listdir(source_html_folder):
                 if file_name.endswith(".html"):
-                    source_html_file = os.path.join(source_html_folder, file_name)
-                    destination_html_file = os.path.join(
-                        destination_html_folder, file_name
+                    files[folder_name][os.path.join(folder_name, file_name)] = (
+                        os.path.join(source_html_folder, file_name)
                     )
-                    if not os.path.exists(destination_html_file) or not filecmp.cmp(
-                        source_html_file, destination_html_file, shallow=False
-                    ):
-                        shutil.copy2(source_html_file, destination_html_file)
             for folder in ["includes", "styles"]:
-                source_folder = os.path.join(source_html_folder, folder)
-                if os.path.exists(source_folder):
-                    destination_folder = os.path.join(destination_html_folder, folder)
-                    shutil.copytree(
-                        source_folder, destination_folder, dirs_exist_ok=True
+                files[folder_name].update(
+                    get_folder_files(
+                        os.path.join(source_html_folder, folder),
+                        os.path.join(folder_name, folder),
                     )
+                )
 
             if include_pdfs_with_markdown_and_html:
-                source_pdf_folder = os.path.join(pdf_output_folder, folder_name)
-                source_pdf_file = os.path.join(source_pdf_folder, "document.pdf")
+                source_pdf_file = os.path.join(
+                    pdf_output_folder, folder_name, "document.pdf"
+                )
                 if os.path.exists(source_pdf_file):
-                    destination_pdf_folder = os.path.join(
-                        destination_html_folder, "includes"
-                    )
-                    os.makedirs(destination_pdf_folder, exist_ok=True)
-                    destination_pdf_file = os.path.join(
-                        destination_pdf_folder, "document.pdf"
-                    )
-                    shutil.copy2(source_pdf_file, destination_pdf_file)
-
-    index_file = os.path.join(publish_folder_markdown, "index.md")
-    html_file = os.path.join(publish_folder_html, "index.html")
-
-    command = [
-        "pandoc",
-        index_file,
-        "--standalone",
-        "--css",
-        os.path.join("styles", os.path.basename(pandoc_css_file)),
-    ]
-
-    if document_author:
-        command.extend(["-M", f"author={document_author}"])
-    if document_title:
-        command.extend(["-M", f"title={document_title}"])
-
-    command.append("-o")
-    command.append(html_file)
+                    files[folder_name][
+                        os.path.join(folder_name, "includes", "document.pdf")
+                    ] = source_pdf_file
 
-    subprocess.run(command)
+    sync_publish_folder(publish_folder_html, "html", folders, files)
 
-    # now remove the index_file since it is not needed anymore
-    os.remove(index_file)
 
-
-def publish_markdown():
+def publish_markdown(folders, changed_folders):
     pdf_output_folder = config["project_pdf_output_folder"]
     include_pdfs_with_markdown_and_html = config.get(
         "include_pdfs_with_markdown_and_html", False
@@ -1213,249 +2747,1004 @@ def publish_markdown():
     markdown_output_folder = config["project_markdown_output_folder"]
     publish_folder_markdown = config["publish_folder_markdown"]
 
-    document_order = config.get("toc_order", [])
-    document_heading = config.get("toc_heading", "")
-
     if not publish_folder_markdown or not os.path.exists(publish_folder_markdown):
         return  # Do nothing if path is empty or doesn't exist
 
-    os.makedirs(publish_folder_markdown, exist_ok=True)
-
-    readme_contents = []
-    index_contents = []
-    if document_heading:
-        readme_contents.append(f"# {document_heading}\n")
-        index_contents.append(f"# {document_heading}\n")
-
-    folders = os.listdir(markdown_output_folder)
-    if document_order:
-        folders.sort(
-            key=lambda folder: (
-                document_order.index(folder)
-                if folder in document_order
-                else float("inf")
-            )
-        )
-    else:
-        folders.sort(key=str.lower)
-
+    files = {}
     disallowed_names = ["styles", "index.html", "index.md", "README.md", "pdf"]
-    for folder_name in folders:
+    for folder_name in get_folders_to_publish(
+        publish_folder_markdown, "markdown", folders, changed_folders
+    ):
         if folder_name in disallowed_names:
             pretty_print_error(f"Skipping document called '{folder_name}'")
             continue
+
+        files[folder_name] = {}
         source_markdown_folder = os.path.join(markdown_output_folder, folder_name)
         if os.path.isdir(source_markdown_folder):
-            destination_markdown_folder = os.path.join(
-                publish_folder_markdown, folder_name
-            )
-            os.makedirs(destination_markdown_folder, exist_ok=True)
             for file_name in os.listdir(source_markdown_folder):
                 if file_name.endswith(".md"):
-                    source_markdown_file = os.path.join(
-                        source_markdown_folder, file_name
+                    files[folder_name][os.path.join(folder_name, file_name)] = (
+                        os.path.join(source_markdown_folder, file_name)
                     )
-                    destination_markdown_file = os.path.join(
-                        destination_markdown_folder, file_name
-                    )
-                    if not os.path.exists(destination_markdown_file) or not filecmp.cmp(
-                        source_markdown_file, destination_markdown_file, shallow=False
-                    ):
-                        shutil.copy2(source_markdown_file, destination_markdown_file)
-
-                    formatted_folder_name = folder_name.replace("_", " ")
-                    file_name_without_ext, _ = os.path.splitext(file_name)
-                    if include_pdfs_with_markdown_and_html:
-                        readme_contents.append(
-                            f"- [{formatted_folder_name}]({os.path.join(folder_name, file_name_without_ext + '.md')}) | [PDF]({os.path.join(folder_name, 'includes', file_name_without_ext + '.pdf')})"
-                        )
-                        index_contents.append(
-                            f"- [{formatted_folder_name}]({os.path.join(folder_name, file_name_without_ext + '.html')}) | [PDF]({os.path.join(folder_name, 'includes', file_name_without_ext + '.pdf')})"
-                        )
-                    else:
-                        readme_contents.append(
-                            f"- [{formatted_folder_name}]({os.path.join(folder_name, file_name_without_ext + '.md')})"
-                        )
-                        index_contents.append(
-                            f"- [{formatted_folder_name}]({os.path.join(folder_name, file_name_without_ext + '.html')})"
-                        )
 
-            includes_folder = os.path.join(source_markdown_folder, "includes")
-            if os.path.exists(includes_folder):
-                shutil.copytree(
-                    includes_folder,
-                    os.path.join(destination_markdown_folder, "includes"),
-                    dirs_exist_ok=True,
+            files[folder_name].update(
+                get_folder_files(
+                    os.path.join(source_markdown_folder, "includes"),
+                    os.path.join(folder_name, "includes"),
                 )
+            )
 
             if include_pdfs_with_markdown_and_html:
-                source_pdf_folder = os.path.join(pdf_output_folder, folder_name)
-                source_pdf_file = os.path.join(source_pdf_folder, "document.pdf")
+                source_pdf_file = os.path.join(
+                    pdf_output_folder, folder_name, "document.pdf"
+                )
                 if os.path.exists(source_pdf_file):
-                    destination_pdf_folder = os.path.join(
-                        destination_markdown_folder, "includes"
-                    )
-                    os.makedirs(destination_pdf_folder, exist_ok=True)
-                    destination_pdf_file = os.path.join(
-                        destination_pdf_folder, "document.pdf"
-                    )
-                    shutil.copy2(source_pdf_file, destination_pdf_file)
+                    files[folder_name][
+                        os.path.join(folder_name, "includes", "document.pdf")
+                    ] = source_pdf_file
 
-    license_markdown = get_license_as_markdown()
-    with open(os.path.join(publish_folder_markdown, "README.md"), "w") as readme_file:
-        readme_file.write("\n".join(readme_contents))
-        readme_file.write("\n")
-        if license_markdown != "":
-            readme_file.write("\n" + license_markdown + "\n")
+    sync_publish_folder(publish_folder_markdown, "markdown", folders, files)
 
-    with open(os.path.join(publish_folder_markdown, "index.md"), "w") as index_file:
-        index_file.write("\n".join(index_contents))
-        index_file.write("\n")
-        if license_markdown != "":
-            index_file.write("\n" + license_markdown + "\n")
+    write_file_if_changed(
+        os.path.join(publish_folder_markdown, "README.md"),
+        get_table_of_contents(folders, ".md"),
+    )
 
 
-def publish_pdfs():
+def publish_pdfs(folders, changed_folders):
     pdf_output_folder = config["project_pdf_output_folder"]
     publish_folder_pdf = config["publish_folder_pdf"]
 
     if not publish_folder_pdf or not os.path.exists(publish_folder_pdf):
         return  # Do nothing if path is empty or doesn't exist
 
-    os.makedirs(
-        publish_folder_pdf, exist_ok=True
-    )  # Create the directory if it doesn't exist
+    files = {}
+    for folder_name in get_folders_to_publish(
+        publish_folder_pdf, "pdf", folders, changed_folders
+    ):
+        files[folder_name] = {}
+        source_pdf_file = os.path.join(pdf_output_folder, folder_name, "document.pdf")
+        if os.path.exists(source_pdf_file):
+            files[folder_name][f"{folder_name}.pdf"] = source_pdf_file
+
+    sync_publish_folder(publish_folder_pdf, "pdf", folders, files)
+
+
+def record_artifacts(folders, artifact, fingerprints, assignment=False):
+    # Record the fingerprints computed from the snapshot taken at the start of
+    # the run, so that edits made while the run was in progress are picked up
+    # by the next run. An artifact whose outputs are missing is not recorded.
+    project_root = config["project_root"]
+
+    with build_state:
+        for folder in folders:
+            outputs = get_artifact_outputs(folder, artifact, assignment)
+            if not all(os.path.exists(output) for output in outputs):
+                continue
+            build_state.execute(
+                """
+                INSERT OR REPLACE INTO artifacts (folder, artifact, fingerprint)
+                VALUES (?, ?, ?)
+                """,
+                (folder, artifact, fingerprints[(folder, artifact)]),
+            )
+            build_state.execute(
+                "DELETE FROM outputs WHERE folder = ? AND artifact = ?",
+                (folder, artifact),
+            )
+            build_state.executemany(
+                "INSERT INTO outputs (folder, artifact, path) VALUES (?, ?, ?)",
+                [
+                    (folder, artifact, os.path.relpath(output, project_root))
+                    for output in outputs
+                ],
+            )
 
-    for folder_name in os.listdir(pdf_output_folder):
-        source_pdf_folder = os.path.join(pdf_output_folder, folder_name)
-        if os.path.isdir(source_pdf_folder):
-            for file_name in os.listdir(source_pdf_folder):
-                if file_name.endswith(".pdf"):
-                    source_pdf_file = os.path.join(source_pdf_folder, file_name)
-                    destination_pdf_file = os.path.join(
-                        publish_folder_pdf, f"{folder_name}.pdf"
-                    )
-                    if not os.path.exists(destination_pdf_file) or not filecmp.cmp(
-                        source_pdf_file, destination_pdf_file, shallow=False
-                    ):
-                        shutil.copy2(source_pdf_file, destination_pdf_file)
 
+def report_failures(failures):
+    if not failures:
+        return
 
-def remove_pagebreaks(folders):
-    markdown_output_folder = config["project_markdown_output_folder"]
+    pretty_print_error(f"{len(failures)} output(s) failed to build:")
+    for _, label, reason in failures:
+        pretty_print_error(f"  {label}: {reason}")
+
+
+def run_benchmark(args):
+    # Generates a synthetic project in a temporary folder (see
+    # generate_benchmark_markdown) and processes it three times: from
+    # scratch, again with nothing changed, and after one document has been
+    # edited, reporting the wall time of each stage of each run. Unless
+    # args.real_tools is set, pandoc and the lint tools are replaced by stubs
+    # that do almost nothing, so that the time measured is that of this
+    # script.
+    script = os.path.realpath(__file__)
+    bench_folder = tempfile.mkdtemp(prefix="document-builder-bench-")
+    project_folder = os.path.join(bench_folder, "project")
+    markdown_folder = os.path.join(bench_folder, "markdown")
+    env = os.environ.copy()
 
-    for folder in folders:
-        markdown_file = os.path.join(markdown_output_folder, folder, "document.md")
-        with open(markdown_file, "r+") as f:
-            lines = f.readlines()
+    try:
+        if not args.real_tools:
+            # the stub pandoc parses Markdown into headings, page breaks and
+            # paragraphs, enough for assignments to be split into questions,
+            # and writes its input as any other output
+            stubs = {
+                "pandoc": f"""\
+                    #!{sys.executable}
+                    import json, os, re, sys
+                    args = sys.argv[1:]
+                    if "--version" in args:
+                        print("pandoc 0.0 (benchmark stub)")
+                        sys.exit(0)
+                    inputs = [a for a in args if a.endswith((".md", ".json")) and os.path.isfile(a)]
+                    text = open(inputs[0]).read() if inputs else sys.stdin.read()
+                    if "--to" in args and args[args.index("--to") + 1] == "json":
+                        blocks = []
+                        for block in re.split(r"\\n\\s*\\n", text):
+                            block = block.strip()
+                            heading = re.match(r"^(#+)\\s+(.*)", block)
+                            if heading:
+                                blocks.append({{"t": "Header", "c": [len(heading.group(1)), ["", [], []], [{{"t": "Str", "c": heading.group(2)}}]]}})
+                            elif block == "\\\\pagebreak":
+                                blocks.append({{"t": "RawBlock", "c": ["latex", block]}})
+                            elif re.match(r"^```{{=latex}}\\n.*\\n```$", block, re.S):
+                                blocks.append({{"t": "RawBlock", "c": ["latex", block.split("\\n")[1]]}})
+                            elif block:
+                                blocks.append({{"t": "Para", "c": [{{"t": "Str", "c": block}}]}})
+                        text = json.dumps({{"pandoc-api-version": [1, 23, 1], "meta": {{}}, "blocks": blocks}})
+                    with open(args[args.index("-o") + 1], "w") as f:
+                        f.write(text)
+                    """,
+                "spellchecker": "#!/bin/sh\n",
+                "markdown-link-check": "#!/bin/sh\n",
+                "mdl": "#!/bin/sh\n",
+            }
+            stubs_folder = os.path.join(bench_folder, "bin")
+            os.makedirs(stubs_folder)
+            for name, content in stubs.items():
+                stub_file = os.path.join(stubs_folder, name)
+                with open(stub_file, "w") as f:
+                    f.write(textwrap.dedent(content))
+                os.chmod(stub_file, 0o755)
+            env["PATH"] = os.pathsep.join([stubs_folder, env.get("PATH", "")])
+
+        pretty_print(f"Generating benchmark project in {bench_folder}...", args.verbose)
+        os.makedirs(markdown_folder)
+        words = generate_benchmark_markdown(markdown_folder, args)
+        words_file = os.path.join(bench_folder, "words.txt")
+        with open(words_file, "w") as f:
+            f.write("".join(f"{word}\n" for word in words))
+
+        subprocess.run(
+            [sys.executable, script, "create", "-p", project_folder],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        # the words of the documents are the spellchecker's dictionary, so
+        # that the benchmark doesn't depend on the system's
+        config_file = os.path.join(project_folder, "config", "config.json")
+        with open(config_file, "r+") as f:
+            project_config = json.load(f)
+            project_config["spellchecker_dictionary"] = words_file
             f.seek(0)
+            json.dump(project_config, f, indent=4)
             f.truncate()
-            i = 0
-            while i < len(lines):
-                if lines[i].strip() == "\\pagebreak":
-                    i += 1
-                    # Skip the next line if it's blank
-                    if i < len(lines) and not lines[i].strip():
-                        i += 1
+        subprocess.run(
+            [sys.executable, script, "import", "-c", config_file, "-m", markdown_folder],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+        for number in range(1, args.documents + 1):
+            data_folder = os.path.join(
+                project_folder, "source", f"document_{number:03d}", "data"
+            )
+            for index in range(1, args.data_files + 1):
+                with open(os.path.join(data_folder, f"data_{index}.txt"), "wb") as f:
+                    f.write(os.urandom(args.data_size * 1024))
+
+        process = [sys.executable, script, "process", "-c", config_file, "-v"]
+        process.extend(["--jobs", str(args.jobs), "--data-jobs", str(args.data_jobs)])
+        if args.questions:
+            process.append("--assignment")
+
+        runs = {}
+        for run in ["cold", "warm", "touched"]:
+            if run == "touched":
+                with open(
+                    os.path.join(project_folder, "source", "document_001", "document.md"),
+                    "a",
+                ) as f:
+                    f.write("\nOne more paragraph.\n")
+            pretty_print(f"Processing the project ({run})...", args.verbose)
+            stages = time_process_stages(process, env)
+            if stages is None:
+                sys.exit(1)
+            runs[run] = dict(stages)
+
+        messages = list(dict.fromkeys(message for stages in runs.values() for message in stages))
+        width = max(len(message) for message in messages + ["Total"])
+        print(f"{'Stage':<{width}}" + "".join(f"{run:>10}" for run in runs))
+        for message in messages:
+            times = [
+                f"{stages[message]:>9.3f}s" if message in stages else f"{'-':>10}"
+                for stages in runs.values()
+            ]
+            print(f"{message:<{width}}" + "".join(times))
+        totals = [f"{sum(stages.values()):>9.3f}s" for stages in runs.values()]
+        print(f"{'Total':<{width}}" + "".join(totals))
+    finally:
+        if args.keep:
+            pretty_print_emphasis(f"The benchmark project was kept in {bench_folder}")
+        else:
+            shutil.rmtree(bench_folder, ignore_errors=True)
+
+
+def run_cached_lint_tool(command, log_name, markdown_files):
+    # Runs a lint tool on the documents whose log isn't in the lint cache,
+    # and writes the logs of the others from the cache. Logs are cached in
+    # the lint folder of the build cache, under a hash of the tool, its
+    # version, the document's path and content, and the settings the tool
+    # uses, so they survive --force and --remove. Logs of the link checkers
+    # are only used for link_check_cache_hours, since links can break
+    # without the document changing. markdown_files maps each file to the
+    # folder of its document.
+    build_logs_folder = config["project_build_logs_folder"]
+    cache_folder = os.path.join(config["project_build_cache_folder"], "lint")
+
+    # the version of the built-in tools is that of this script
+    settings = ""
+    if command == ["markdown-link-check"] and (
+        config.get("link_checker", "markdown-link-check") == "builtin"
+    ):
+        run_tool = run_link_checker
+        version = hash_file(os.path.realpath(__file__))
+    elif command[0] == "spellchecker" and (
+        config.get("spellchecker", "spellchecker") == "builtin"
+    ):
+        run_tool = run_spellchecker
+        version = hash_file(os.path.realpath(__file__))
+        settings = get_spellchecker_fingerprint()[1]
+    else:
+
+        def run_tool(files):
+            run_lint_tool(command, files, log_name)
+
+        version = get_command_output([command[0], "--version"])
+        settings = get_lint_tool_settings(command)
+
+    max_age = None
+    if log_name == "markdown_link_check.log":
+        max_age = config.get("link_check_cache_hours", 24) * 3600
+
+    cache_files = {}
+    files_to_check = {}
+    for markdown_file, folder in markdown_files.items():
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    command,
+                    log_name,
+                    version,
+                    markdown_file,
+                    hash_file(markdown_file),
+                    settings,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+        cache_file = os.path.join(cache_folder, f"{key}.log")
+        cache_files[markdown_file] = cache_file
+        if os.path.exists(cache_file) and (
+            max_age is None or time.time() - os.path.getmtime(cache_file) < max_age
+        ):
+            log_folder = os.path.join(build_logs_folder, folder)
+            os.makedirs(log_folder, exist_ok=True)
+            shutil.copyfile(cache_file, os.path.join(log_folder, log_name))
+        else:
+            files_to_check[markdown_file] = folder
+
+    if not files_to_check:
+        return
+    run_tool(files_to_check)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    for markdown_file, folder in files_to_check.items():
+        log_file = os.path.join(build_logs_folder, folder, log_name)
+        cache_file = cache_files[markdown_file]
+        if os.path.exists(log_file):
+            shutil.copyfile(log_file, f"{cache_file}.tmp")
+            os.replace(f"{cache_file}.tmp", cache_file)
+
+
+def run_commands(commands, jobs=1):
+    # commands is a list of (key, label, command, input) tuples, where key
+    # identifies the artifact being built and input is the text passed to the
+    # command on stdin. Each command is run on a bounded worker pool and its
+    # output is captured so that the output of concurrent commands does not
+    # interleave. The (key, label, reason) of each failed command is returned.
+    failures = []
+
+    def run(command, input_text):
+        # outputs built in several steps are given as a function taking the
+        # input and returning a subprocess.CompletedProcess
+        if callable(command):
+            return command(input_text)
+        return subprocess.run(
+            command,
+            input=input_text,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {
+            executor.submit(run, command, input_text): (key, label)
+            for key, label, command, input_text in commands
+        }
+        for future in as_completed(futures):
+            key, label = futures[future]
+            try:
+                result = future.result()
+            except OSError as e:
+                failures.append((key, label, str(e)))
+                continue
+            if result.stdout:
+                print(f"{label}:\n{result.stdout.rstrip()}")
+            if result.returncode != 0:
+                failures.append(
+                    (key, label, f"exited with status {result.returncode}")
+                )
+
+    return failures
+
+
+def run_link_checker(markdown_files):
+    # The built-in link checker. The links of all the documents are
+    # collected and each distinct URL is checked once (see check_urls),
+    # unless it was checked less than link_check_cache_hours ago. Links to
+    # files are checked relative to the document. A log is written for each
+    # document, in the format of markdown-link-check. markdown_files maps
+    # each file to the folder of its document.
+    build_logs_folder = config["project_build_logs_folder"]
+    cache_file = os.path.join(config["project_build_cache_folder"], "link_check.json")
+    max_age = config.get("link_check_cache_hours", 24) * 3600
+
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r") as f:
+                cache = json.load(f)
+        except json.JSONDecodeError:
+            pass
+
+    links = {}
+    for markdown_file in markdown_files:
+        with open(markdown_file, "r") as f:
+            content = f.read()
+        # links to other schemes (e.g. mailto:), anchors within the document
+        # and the data download link placeholder are not checked
+        links[markdown_file] = [
+            link
+            for link in get_markdown_links(content)
+            if link.startswith(("http://", "https://"))
+            or not (
+                re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*:", link)
+                or link.startswith("#")
+                or link == "[DATA_DOWNLOAD_LINK]"
+            )
+        ]
+
+    now = time.time()
+    urls = [
+        link
+        for file_links in links.values()
+        for link in file_links
+        if link.startswith(("http://", "https://"))
+        and (link not in cache or now - cache[link]["checked"] >= max_age)
+    ]
+    urls = list(dict.fromkeys(urls))
+    results = {}
+    if urls:
+        for url, (status, alive) in check_urls(urls).items():
+            results[url] = {"status": status, "alive": alive, "checked": now}
+
+    # only the responses of servers are cached, not errors such as timeouts,
+    # and results older than link_check_cache_hours are checked again anyway
+    cache = {
+        url: result
+        for url, result in cache.items()
+        if now - result["checked"] < max_age
+    }
+    cache.update(
+        (url, result)
+        for url, result in results.items()
+        if isinstance(result["status"], int)
+    )
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(f"{cache_file}.tmp", "w") as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+    os.replace(f"{cache_file}.tmp", cache_file)
+
+    for markdown_file, folder in markdown_files.items():
+        lines = [f"FILE: {markdown_file}"]
+        dead_lines = []
+        for link in links[markdown_file]:
+            if link.startswith(("http://", "https://")):
+                result = results.get(link) or cache[link]
+                status, alive = result["status"], result["alive"]
+            else:
+                file_path = urllib.parse.unquote(re.split(r"[#?]", link)[0])
+                alive = os.path.exists(
+                    os.path.join(os.path.dirname(markdown_file), file_path)
+                )
+                status = 200 if alive else 400
+            if alive:
+                lines.append(f"  [✓] {link}")
+            else:
+                lines.append(f"  [✖] {link} → Status: {status}")
+                dead_lines.append(lines[-1])
+        lines.extend(["", f"  {len(links[markdown_file])} links checked.", ""])
+        if dead_lines:
+            lines.append(f"  ERROR: {len(dead_lines)} dead links found!")
+            lines.extend(dead_lines)
+
+        log_folder = os.path.join(build_logs_folder, folder)
+        os.makedirs(log_folder, exist_ok=True)
+        with open(os.path.join(log_folder, "markdown_link_check.log"), "w") as f:
+            f.write("".join(f"{line}\n" for line in lines))
+
+
+def run_lint_tool(command, markdown_files, log_name):
+    # Runs a lint tool on many Markdown files at once and splits its output
+    # into a log for each document. markdown_files maps each file to the
+    # folder of its document. A line starting with the path of a file (or
+    # "FILE: " and the path) starts that file's output, which continues over
+    # the indented and blank lines that follow. Other lines, such as the
+    # summary at the end, count the problems of the whole batch and are
+    # dropped, unless the tool failed without reporting any file, in which
+    # case its output is added to the log of every file of the batch.
+    build_logs_folder = config["project_build_logs_folder"]
+    files = list(markdown_files)
+
+    outputs = {file: [] for file in files}
+    for start in range(0, len(files), lint_batch_size):
+        batch = files[start : start + lint_batch_size]
+        result = subprocess.run(
+            command + batch,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+        current_file = None
+        batch_lines = []
+        for line in result.stdout.splitlines():
+            # Remove ANSI color codes
+            line = re.sub(r"\x1B\[[0-?]*[ -/]*[@-~]", "", line)
+            line_file = get_lint_line_file(line, files)
+            if line_file:
+                current_file = line_file
+            elif line and not line[0].isspace():
+                current_file = None
+            if current_file:
+                outputs[current_file].append(line)
+            elif line:
+                batch_lines.append(line)
+        if result.returncode != 0 and not any(outputs[file] for file in batch):
+            for file in batch:
+                outputs[file].extend(batch_lines)
+
+    for file, folder in markdown_files.items():
+        log_folder = os.path.join(build_logs_folder, folder)
+        os.makedirs(log_folder, exist_ok=True)
+        with open(os.path.join(log_folder, log_name), "w") as f:
+            f.write("".join(f"{line}\n" for line in outputs[file]))
+
+
+def run_lint_tools(folders):
+    # Runs the spellchecker, link checker and Markdown linter at the same
+    # time, each on all the documents at once, except those whose logs are
+    # cached (see run_cached_lint_tool)
+    source_folder = config["project_source_folder"]
+
+    markdown_files = {}
+    for folder in folders:
+        markdown_file = os.path.join(source_folder, folder, "document.md")
+        if os.path.exists(markdown_file):
+            markdown_files[markdown_file] = folder
+    if not markdown_files:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(lint_tools)) as executor:
+        futures = [
+            executor.submit(run_cached_lint_tool, command, log_name, markdown_files)
+            for command, log_name in lint_tools
+        ]
+        for future in futures:
+            future.result()
+
+
+def run_latex(engine, latex_folder, format_name=None):
+    # Runs the LaTeX engine on document.tex in latex_folder until its
+    # auxiliary files stop changing, at most three times. Returns the
+    # subprocess.CompletedProcess of the last run, with the output trimmed
+    # to the error if it failed.
+    command = [engine, "-interaction=nonstopmode", "-halt-on-error"]
+    env = os.environ.copy()
+    if format_name:
+        formats_folder = os.path.join(
+            config["project_build_cache_folder"], "latex", "formats"
+        )
+        command.append(f"-fmt={format_name}")
+        env["TEXFORMATS"] = os.path.abspath(formats_folder) + os.pathsep
+    command.append("document.tex")
+
+    def get_auxiliary_hashes():
+        hashes = {}
+        for extension in [".aux", ".toc", ".out", ".lof", ".lot"]:
+            file_path = os.path.join(latex_folder, f"document{extension}")
+            if os.path.exists(file_path):
+                hashes[extension] = hash_file(file_path)
+        return hashes
+
+    for _ in range(3):
+        auxiliary_hashes = get_auxiliary_hashes()
+        result = subprocess.run(
+            command,
+            cwd=latex_folder,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+        )
+        if result.returncode != 0:
+            lines = result.stdout.splitlines()
+            errors = [i for i, line in enumerate(lines) if line.startswith("!")]
+            if errors:
+                result.stdout = "\n".join(lines[errors[0] : errors[0] + 20]) + "\n"
+            return result
+        if get_auxiliary_hashes() == auxiliary_hashes:
+            break
+
+    result.stdout = ""
+    return result
+
+
+def run_spellchecker(markdown_files):
+    # The built-in spellchecker. Each paragraph outside fenced code blocks
+    # is checked against the dictionary and word list (see
+    # get_spellchecker_words and check_spelling), unless a paragraph with
+    # the same text was checked with the same words before: the results are
+    # kept in the build cache by the hash of both. A log is written for each
+    # document, in the format of spellchecker. markdown_files maps each file
+    # to the folder of its document.
+    build_logs_folder = config["project_build_logs_folder"]
+    cache_file = os.path.join(
+        config["project_build_cache_folder"], "spellchecker", "paragraphs.json"
+    )
+    words, fingerprint = get_spellchecker_words()
+
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r") as f:
+                cache = json.load(f)
+        except json.JSONDecodeError:
+            pass
+
+    results = {}
+    for markdown_file, folder in markdown_files.items():
+        with open(markdown_file, "r", encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+
+        # paragraphs are lists of lines, after the number of their first line
+        paragraphs = []
+        fence = None
+        in_paragraph = False
+        for number, line in enumerate(lines, 1):
+            fence_match = re.match(r"^ {0,3}(`{3,}|~{3,})", line)
+            if fence:
+                if fence_match and fence_match.group(1).startswith(fence):
+                    fence = None
+            elif fence_match:
+                fence = fence_match.group(1)
+                in_paragraph = False
+            elif is_blank(line):
+                in_paragraph = False
+            else:
+                if not in_paragraph:
+                    paragraphs.append((number, []))
+                    in_paragraph = True
+                paragraphs[-1][1].append(line)
+
+        misspelt = []
+        for start, paragraph in paragraphs:
+            key = hashlib.sha256(
+                "\n".join([fingerprint] + paragraph).encode("utf-8")
+            ).hexdigest()
+            if key not in results:
+                if key in cache:
+                    results[key] = cache[key]
                 else:
-                    f.write(lines[i])
-                    i += 1
+                    results[key] = check_spelling(paragraph, words)
+            for index, column, word in results[key]:
+                misspelt.append((start + index, column + 1, word))
+
+        if misspelt:
+            log_lines = [markdown_file]
+            for number, column, word in misspelt:
+                position = f"{number}:{column}-{number}:{column + len(word)}"
+                log_lines.append(
+                    f"  {position}  warning  `{word}` is misspelt  spelling  retext-spell"
+                )
+            warnings = "warning" if len(misspelt) == 1 else "warnings"
+            log_lines.extend(["", f"⚠ {len(misspelt)} {warnings}"])
+        else:
+            log_lines = [f"{markdown_file}: no issues found"]
+
+        log_folder = os.path.join(build_logs_folder, folder)
+        os.makedirs(log_folder, exist_ok=True)
+        with open(os.path.join(log_folder, "spellchecker.log"), "w") as f:
+            f.write("".join(f"{line}\n" for line in log_lines))
+
+    # the paragraphs checked in this run are kept, and as many of the others
+    # as fit in spellcheck_cache_size
+    for key, result in cache.items():
+        if len(results) >= spellcheck_cache_size:
+            break
+        results.setdefault(key, result)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(f"{cache_file}.tmp", "w") as f:
+        json.dump(results, f)
+    os.replace(f"{cache_file}.tmp", cache_file)
+
+
+def snapshot_build_state(folders, kinds=("document", "settings", "data", "link")):
+    # Record the current state of the tracked files of the given kinds. Files
+    # whose size and modification time are unchanged are not hashed again.
+    project_root = config["project_root"]
+    placeholders = ", ".join("?" for _ in kinds)
+
+    with build_state:
+        folder_placeholders = ", ".join("?" for _ in folders)
+        for table in ["files", "artifacts", "outputs"]:
+            build_state.execute(
+                f"DELETE FROM {table} WHERE folder NOT IN ({folder_placeholders})",
+                folders,
+            )
+
+        for folder in folders:
+            previous = {
+                path: (size, mtime_ns, file_hash)
+                for path, size, mtime_ns, file_hash in build_state.execute(
+                    f"""
+                    SELECT path, size, mtime_ns, hash FROM files
+                    WHERE folder = ? AND kind IN ({placeholders})
+                    """,
+                    (folder, *kinds),
+                )
+            }
+            current = set()
+            for file_path, kind in get_tracked_files(folder):
+                if kind not in kinds:
+                    continue
+                path = os.path.relpath(file_path, project_root)
+                current.add(path)
+                stat = os.stat(file_path)
+                if path in previous and previous[path][:2] == (
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ):
+                    continue
+                build_state.execute(
+                    """
+                    INSERT OR REPLACE INTO files (path, folder, kind, size, mtime_ns, hash)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        path,
+                        folder,
+                        kind,
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        hash_file(file_path),
+                    ),
+                )
+            build_state.executemany(
+                "DELETE FROM files WHERE path = ?",
+                [(path,) for path in previous if path not in current],
+            )
 
 
-def replace_data_download_links_in_markdown(folders):
-    markdown_output_folder = config["project_markdown_output_folder"]
-    data_to_share_links_folder = config["project_data_to_share_links_folder"]
+def split_feedback_ast(ast):
+    # Splits the AST of the instructor version of an assignment into one AST
+    # per question, at the anchors generate_assignment_markdown puts before
+    # each question and where the questions end. Returns a dict mapping each
+    # question number to its AST. Raises ValueError if an anchor is inside
+    # another block, such as a div, where the AST can't be split.
+    def find_anchor(node):
+        if isinstance(node, list):
+            for item in node:
+                match = find_anchor(item)
+                if match:
+                    return match
+            return None
+        if not isinstance(node, dict):
+            return None
+        if node.get("t") == "RawBlock":
+            return feedback_anchor.search(node["c"][1])
+        return find_anchor(node.get("c"))
+
+    questions = {}
+    question_number = None
+    for block in ast["blocks"]:
+        match = find_anchor(block)
+        if match and block["t"] != "RawBlock":
+            if match.group(1) == "end":
+                raise ValueError("The end of the questions is inside another block")
+            raise ValueError(f"Question {match.group(1)} is inside another block")
+        if match:
+            question_number = None if match.group(1) == "end" else match.group(1)
+            if question_number is not None:
+                questions[question_number] = []
+        elif question_number is not None:
+            questions[question_number].append(block)
+
+    return {
+        question_number: dict(ast, blocks=question_blocks)
+        for question_number, question_blocks in questions.items()
+    }
 
-    for folder in folders:
-        markdown_file = os.path.join(markdown_output_folder, folder, "document.md")
-        with open(markdown_file, "r+") as f:
-            content = f.read()
-            link_file_path = os.path.join(data_to_share_links_folder, f"{folder}.txt")
-            if os.path.exists(link_file_path):
-                with open(link_file_path, "r") as link_file:
-                    link = link_file.read().strip()
-                if link:  # Check if link is not empty
-                    if "([DATA_DOWNLOAD_LINK])" in content:
-                        content = content.replace("([DATA_DOWNLOAD_LINK])", f"({link})")
-                    if "[DATA_DOWNLOAD_LINK]" in content:
-                        # Split the link into chunks of 80 characters
-                        link_parts = [link[i : i + 80] for i in range(0, len(link), 80)]
-                        # Add a backslash at the end of each line, except for the last line
-                        link = "\n".join(
-                            [
-                                f"{part}\\" if i < len(link_parts) - 1 else f"{part}"
-                                for i, part in enumerate(link_parts)
-                            ]
-                        )
-                        # Add double quotes at the start and end of the link
-                        link = f'"{link}"'
-                        content = content.replace("[DATA_DOWNLOAD_LINK]", link)
-                    f.seek(0)
-                    f.write(content)
-                    f.truncate()
 
+def stringify_ast(node):
+    # Returns the text of a pandoc AST node, without formatting
+    if isinstance(node, list):
+        return "".join(stringify_ast(item) for item in node)
+    if not isinstance(node, dict):
+        return ""
+    if node["t"] == "Str":
+        return node["c"]
+    if node["t"] in ["Space", "SoftBreak", "LineBreak"]:
+        return " "
+    if node["t"] in ["Code", "Math"]:
+        return node["c"][1]
+    return stringify_ast(node.get("c", []))
+
+
+def sync_publish_folder(publish_folder, kind, folders, files):
+    # Publishes files ({document folder: {path relative to publish_folder:
+    # source path}}, with files shared by all documents under "") and removes
+    # the files published by an earlier run that are no longer wanted. What
+    # was published is recorded in a manifest in publish_folder, one per kind
+    # of output since publish folders can be shared. Published files are only
+    # compared by their size and modification time and never read. The
+    # folders that are not in files are left as they are, unless they are no
+    # longer in folders, in which case their files are removed. Files that
+    # are not in the manifest are never removed. Returns the paths of the
+    # files that were copied.
+    manifest = load_publish_manifest(publish_folder, kind)
+
+    new_manifest = {
+        folder: entries
+        for folder, entries in manifest.items()
+        if folder in folders and folder not in files
+    }
+    stale_files = [
+        relative_path
+        for folder, entries in manifest.items()
+        if folder not in new_manifest
+        for relative_path in entries
+        if relative_path not in files.get(folder, {})
+    ]
 
-def run_spellchecker(folders):
-    source_folder = config["project_source_folder"]
-    build_logs_folder = config["project_build_logs_folder"]
+    copied_files = []
+    for folder, folder_files in files.items():
+        previous_entries = manifest.get(folder, {})
+        new_manifest[folder] = {}
+        for relative_path, source_file in sorted(folder_files.items()):
+            destination_file = os.path.join(publish_folder, relative_path)
+            source_stat = os.stat(source_file)
+            entry = previous_entries.get(relative_path)
+            if entry is not None and (
+                entry["source_size"],
+                entry["source_mtime_ns"],
+            ) == (source_stat.st_size, source_stat.st_mtime_ns):
+                source_hash = entry["hash"]
+            else:
+                source_hash = hash_file(source_file)
 
-    for folder in folders:
-        markdown_file = os.path.join(source_folder, folder, "document.md")
-        if os.path.exists(markdown_file):
-            log_folder = os.path.join(build_logs_folder, folder)
-            os.makedirs(log_folder, exist_ok=True)
-            log_file = os.path.join(log_folder, "spellchecker.log")
-            with open(log_file, "w") as f:
-                subprocess.run(
-                    ["spellchecker", "--no-suggestions", markdown_file], stdout=f
-                )
+            if os.path.exists(destination_file):
+                destination_stat = os.stat(destination_file)
+            else:
+                destination_stat = None
+
+            # the published file is up to date if it has the content of the
+            # source and has not been changed since it was published
+            if (
+                entry is None
+                or entry["hash"] != source_hash
+                or destination_stat is None
+                or (destination_stat.st_size, destination_stat.st_mtime_ns)
+                != (entry["size"], entry["mtime_ns"])
+            ):
+                os.makedirs(os.path.dirname(destination_file), exist_ok=True)
+                if copy_file(source_file, destination_file):
+                    copied_files.append(relative_path)
+                destination_stat = os.stat(destination_file)
+
+            new_manifest[folder][relative_path] = {
+                "hash": source_hash,
+                "source_size": source_stat.st_size,
+                "source_mtime_ns": source_stat.st_mtime_ns,
+                "size": destination_stat.st_size,
+                "mtime_ns": destination_stat.st_mtime_ns,
+            }
+
+    # remove the files of documents that were renamed or deleted, and the
+    # folders left empty
+    for relative_path in stale_files:
+        destination_file = os.path.join(publish_folder, relative_path)
+        if os.path.exists(destination_file):
+            os.remove(destination_file)
+        folder = os.path.dirname(destination_file)
+        while (
+            os.path.normpath(folder) != os.path.normpath(publish_folder)
+            and os.path.isdir(folder)
+            and not os.listdir(folder)
+        ):
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+
+    if new_manifest != manifest:
+        manifest_file = os.path.join(publish_folder, f".document-builder-{kind}.json")
+        with open(f"{manifest_file}.tmp", "w") as f:
+            json.dump(new_manifest, f, indent=4)
+        os.replace(f"{manifest_file}.tmp", manifest_file)
+    return copied_files
+
+
+def time_process_stages(command, env):
+    # Runs a process command with --verbose and returns the wall time of each
+    # of its stages as a list of (message, seconds) pairs, a stage lasting
+    # from when its message is printed until the next one is. The time
+    # before the first message is reported as "Starting". Returns None if
+    # the command fails, after printing its output.
+    stages = [["Starting", time.perf_counter()]]
+    output = []
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        env=dict(env, PYTHONUNBUFFERED="1"),
+    )
+    for line in process.stdout:
+        now = time.perf_counter()
+        output.append(line)
+        # the messages starting a stage are green and end with "...", unlike
+        # the messages about each folder and the transform timings
+        match = re.match(r"^\033\[92m(\S.*\.\.\.)\033\[0m$", line.rstrip("\n"))
+        if match:
+            stages.append([match.group(1), now])
+    process.wait()
+    end = time.perf_counter()
+
+    if process.returncode != 0:
+        pretty_print_error(f"{' '.join(command)} exited with status {process.returncode}")
+        print("".join(output[-40:]).rstrip())
+        return None
 
-            # Remove ANSI color codes
-            with open(log_file, "r") as f:
-                lines = f.readlines()
+    return [
+        (message, (stages[i + 1][1] if i + 1 < len(stages) else end) - start)
+        for i, (message, start) in enumerate(stages)
+    ]
 
-            clean_lines = [
-                re.sub(r"\x1B\[[0-?]*[ -/]*[@-~]", "", line) for line in lines
-            ]
 
-            with open(log_file, "w") as f:
-                f.write("".join(clean_lines))
+def transform_data_download_links(folder, content):
+    data_to_share_links_folder = config["project_data_to_share_links_folder"]
 
+    link_file_path = os.path.join(data_to_share_links_folder, f"{folder}.txt")
+    if os.path.exists(link_file_path):
+        with open(link_file_path, "r") as link_file:
+            link = link_file.read().strip()
+        if link:  # Check if link is not empty
+            if "([DATA_DOWNLOAD_LINK])" in content:
+                content = content.replace("([DATA_DOWNLOAD_LINK])", f"({link})")
+            if "[DATA_DOWNLOAD_LINK]" in content:
+                # Split the link into chunks of 80 characters
+                link_parts = [link[i : i + 80] for i in range(0, len(link), 80)]
+                # Add a backslash at the end of each line, except for the last line
+                link = "\n".join(
+                    [
+                        f"{part}\\" if i < len(link_parts) - 1 else f"{part}"
+                        for i, part in enumerate(link_parts)
+                    ]
+                )
+                # Add double quotes at the start and end of the link
+                link = f'"{link}"'
+                content = content.replace("[DATA_DOWNLOAD_LINK]", link)
+    return content
 
-def run_markdown_link_check(folders):
-    source_folder = config["project_source_folder"]
-    build_logs_folder = config["project_build_logs_folder"]
 
-    for folder in folders:
-        markdown_file = os.path.join(source_folder, folder, "document.md")
-        if os.path.exists(markdown_file):
-            log_folder = os.path.join(build_logs_folder, folder)
-            os.makedirs(log_folder, exist_ok=True)
-            log_file = os.path.join(log_folder, "markdown_link_check.log")
-            with open(log_file, "w") as f:
-                subprocess.run(
-                    ["markdown-link-check", markdown_file],
-                    stdout=f,
-                    stderr=subprocess.STDOUT,
-                )
+def transform_includes(folder, content):
+    # Included files are given names based on their content, so that a
+    # changed file is never served from a stale cache
+    source_includes_dir = os.path.join(
+        config["project_source_folder"], folder, "includes"
+    )
+    includes_dir = os.path.join(
+        config["project_markdown_output_folder"], folder, "includes"
+    )
 
+    matches = re.findall(r"!\[.*\]\((.*\..*)\)", content)
+    for match in matches:
+        source_image_path = os.path.join(source_includes_dir, os.path.basename(match))
+        if os.path.exists(source_image_path):
+            with open(source_image_path, "rb") as img_f:
+                readable_hash = hashlib.md5(img_f.read()).hexdigest()
+            new_image_name = f"{readable_hash}{os.path.splitext(match)[1]}"
+            new_image_path = os.path.join(includes_dir, new_image_name)
+            old_image_path = os.path.join(includes_dir, os.path.basename(match))
+            if os.path.exists(old_image_path):
+                os.replace(old_image_path, new_image_path)
+            elif not os.path.exists(new_image_path):
+                os.makedirs(includes_dir, exist_ok=True)
+                copy_file(source_image_path, new_image_path)
+            content = content.replace(match, os.path.join("includes", new_image_name))
+    return content
+
+
+def transform_license(folder, content):
+    license_markdown = get_license_as_markdown()
+    if license_markdown != "":
+        content += "\n" + license_markdown + "\n"
+    return content
+
+
+def transform_markdown(documents, transforms):
+    # Passes the content of each document through the (name, transform) pairs
+    # in transforms and returns the transformed documents. The time spent in
+    # each transform is added to transform_timings.
+    transformed = {}
+    for folder, content in documents.items():
+        for name, transform in transforms:
+            start = time.perf_counter()
+            content = transform(folder, content)
+            transform_timings[name] = (
+                transform_timings.get(name, 0) + time.perf_counter() - start
+            )
+        transformed[folder] = content
+    return transformed
+
+
+def transform_pagebreaks(folder, content):
+    lines = content.splitlines(keepends=True)
+    new_lines = []
+    i = 0
+    while i < len(lines):
+        if lines[i].strip() == "\\pagebreak":
+            i += 1
+            # Skip the next line if it's blank
+            if i < len(lines) and not lines[i].strip():
+                i += 1
+        else:
+            new_lines.append(lines[i])
+            i += 1
+    return "".join(new_lines)
 
-def run_markdown_lint(folders):
-    source_folder = config["project_source_folder"]
-    build_logs_folder = config["project_build_logs_folder"]
 
-    for folder in folders:
-        markdown_file = os.path.join(source_folder, folder, "document.md")
-        if os.path.exists(markdown_file):
-            log_folder = os.path.join(build_logs_folder, folder)
-            os.makedirs(log_folder, exist_ok=True)
-            log_file = os.path.join(log_folder, "markdown_lint.log")
-            with open(log_file, "w") as f:
-                subprocess.run(
-                    ["mdl", markdown_file],
-                    stdout=f,
-                    stderr=subprocess.STDOUT,
-                )
+def unlink_hardlinked_file(file_path):
+    # pandoc rewrites its output file in place, so an output that is hard
+    # linked to its published copy (see copy_file) is removed first
+    if os.path.exists(file_path) and os.stat(file_path).st_nlink > 1:
+        os.remove(file_path)
 
 
 def upload_data_files_to_dropbox_and_set_shareable_links(force=False):
@@ -1463,6 +3752,7 @@ def upload_data_files_to_dropbox_and_set_shareable_links(force=False):
     publish_folder_data = config["publish_folder_data"]
     data_to_share_links_folder = config["project_data_to_share_links_folder"]
     project_id = config["id"]
+    upload_jobs = config.get("dropbox_upload_jobs", 4)
 
     # give error if id is not set
     if not project_id:
@@ -1473,129 +3763,105 @@ def upload_data_files_to_dropbox_and_set_shareable_links(force=False):
 
     dbx = get_dropbox_client()
 
+    # the state of the remote folder and its shared links are fetched once,
+    # rather than once per file
+    remote_files = get_dropbox_folder_files(dbx, f"/{dropbox_folder_name}")
+    shared_links = get_dropbox_shared_links(dbx, f"/{dropbox_folder_name}")
+
+    files_to_upload = []
     file_links = []
-    for file_name in os.listdir(publish_folder_data):
+    for file_name in sorted(os.listdir(publish_folder_data)):
         if file_name.endswith((".zip")):
             source_data_file = os.path.join(publish_folder_data, file_name)
             destination_data_file = f"/{dropbox_folder_name}/{file_name}"
 
             should_upload = force  # If force=True, always upload
 
-            if not force:
-                try:
-                    # Check if the file exists on Dropbox
-                    metadata = dbx.files_get_metadata(destination_data_file)
-                    dropbox_file_time = metadata.server_modified
-
-                    # Get the modification time of the local file in local time
-                    local_file_time_naive = datetime.fromtimestamp(
-                        os.path.getmtime(source_data_file)
-                    )
-
-                    # Convert the local time to UTC
-                    local_file_time = local_file_time_naive.astimezone(timezone.utc)
-
-                    # Convert dropbox_file_time to an offset-aware datetime object
-                    dropbox_file_time = dropbox_file_time.replace(tzinfo=timezone.utc)
-
-                    # Compare the modification times (add small buffer for precision differences)
-                    time_diff = (local_file_time - dropbox_file_time).total_seconds()
-
-                    if time_diff > 1:  # Local file is more than 1 second newer
-                        should_upload = True
-                        pretty_print(
-                            f"  Local file '{file_name}' is newer, will upload", True
-                        )
-                    else:
-                        pretty_print(
-                            f"  File '{file_name}' is up to date on Dropbox, skipping upload",
-                            True,
-                        )
-
-                except (dropbox.exceptions.ApiError, FileNotFoundError) as e:
-                    # File doesn't exist on Dropbox
+            metadata = remote_files.get(file_name.lower())
+            if not force and metadata is None:
+                # File doesn't exist on Dropbox
+                should_upload = True
+                pretty_print(f"File {file_name} not found on Dropbox", True)
+            elif not force:
+                # Compare the content hashes rather than the modification
+                # times, so that identical files are never uploaded again
+                if get_dropbox_content_hash(source_data_file) != metadata.content_hash:
                     should_upload = True
                     pretty_print(
-                        f"File {file_name} not found on Dropbox or error occurred: {e}",
+                        f"  Local file '{file_name}' has changed, will upload", True
+                    )
+                else:
+                    pretty_print(
+                        f"  File '{file_name}' is up to date on Dropbox, skipping upload",
                         True,
                     )
 
             if should_upload:
-                pretty_print(f"Uploading {file_name} to Dropbox...", True)
-                CHUNK_SIZE = 4 * 1024 * 1024  # 4MB
-
-                with open(source_data_file, "rb") as f:
-                    file_size = os.path.getsize(source_data_file)
-                    if file_size <= CHUNK_SIZE:
-                        dbx.files_upload(
-                            f.read(),
-                            destination_data_file,
-                            mode=dropbox.files.WriteMode("overwrite"),
-                        )
-                    else:
-                        upload_session_start_result = dbx.files_upload_session_start(
-                            f.read(CHUNK_SIZE)
-                        )
-                        cursor = dropbox.files.UploadSessionCursor(
-                            session_id=upload_session_start_result.session_id,
-                            offset=f.tell(),
-                        )
-                        commit = dropbox.files.CommitInfo(
-                            path=destination_data_file,
-                            mode=dropbox.files.WriteMode("overwrite"),
-                        )
-
-                        while f.tell() < file_size:
-                            if (file_size - f.tell()) <= CHUNK_SIZE:
-                                dbx.files_upload_session_finish(
-                                    f.read(file_size - f.tell()), cursor, commit
-                                )
-                            else:
-                                dbx.files_upload_session_append_v2(
-                                    f.read(CHUNK_SIZE), cursor
-                                )
-                                cursor.offset = f.tell()
-
-                # Create a shareable link for the file
-                try:
-                    shared_link_metadata = dbx.sharing_create_shared_link_with_settings(
-                        destination_data_file
-                    )
-                except dropbox.exceptions.ApiError as err:
-                    if "shared_link_already_exists" in str(err):
-                        # If the link already exists, retrieve the existing link
-                        shared_links = dbx.sharing_list_shared_links(
-                            path=destination_data_file
-                        ).links
-                        if shared_links:
-                            shared_link_metadata = shared_links[0]
-                        else:
-                            pretty_print_error(
-                                f"Failed to retrieve the existing shareable link for {file_name}"
-                            )
-                            continue
-                    else:
-                        pretty_print_error(
-                            f"Failed to create a shareable link for {file_name}: {err}"
-                        )
-                        continue
-
-                # Create a tuple of the file name and the shareable link and add it to the list
-                file_links.append((file_name, shared_link_metadata.url))
+                files_to_upload.append((file_name, source_data_file, destination_data_file))
+            elif destination_data_file.lower() in shared_links:
+                file_links.append(
+                    (file_name, shared_links[destination_data_file.lower()])
+                )
             else:
                 # File wasn't uploaded but we still need to get/create the shareable link
-                try:
-                    # Try to get existing shared links
-                    shared_links = dbx.sharing_list_shared_links(
-                        path=destination_data_file
-                    ).links
-                    if shared_links:
-                        shared_link_metadata = shared_links[0]
-                        file_links.append((file_name, shared_link_metadata.url))
-                except dropbox.exceptions.ApiError as err:
-                    pretty_print_error(
-                        f"Failed to get shareable link for {file_name}: {err}"
-                    )
+                files_to_upload.append((file_name, None, destination_data_file))
+
+    # upload the files, committing the upload sessions of large files
+    # together once all of them have been uploaded
+    uploaded_files = []
+    upload_sessions = []
+    with ThreadPoolExecutor(max_workers=max(1, upload_jobs)) as executor:
+        futures = {
+            executor.submit(
+                upload_file_to_dropbox, dbx, source_data_file, destination_data_file
+            ): (file_name, source_data_file)
+            for file_name, source_data_file, destination_data_file in files_to_upload
+            if source_data_file is not None
+        }
+        for future in as_completed(futures):
+            file_name, source_data_file = futures[future]
+            try:
+                finish_arg = future.result()
+            except dropbox.exceptions.ApiError as err:
+                pretty_print_error(f"Failed to upload {file_name} to Dropbox: {err}")
+                continue
+            if finish_arg is None:
+                pretty_print(f"Uploaded {file_name} to Dropbox", True)
+                uploaded_files.append(file_name)
+            else:
+                upload_sessions.append((file_name, source_data_file, finish_arg))
+
+    if upload_sessions:
+        try:
+            uploaded_files.extend(finish_dropbox_upload_sessions(dbx, upload_sessions))
+        except dropbox.exceptions.ApiError as err:
+            pretty_print_error(f"Failed to commit uploads to Dropbox: {err}")
+
+    def get_link(destination_data_file):
+        if destination_data_file.lower() in shared_links:
+            return shared_links[destination_data_file.lower()]
+        return get_dropbox_shared_link(dbx, destination_data_file)
+
+    with ThreadPoolExecutor(max_workers=max(1, upload_jobs)) as executor:
+        futures = {
+            executor.submit(get_link, destination_data_file): file_name
+            for file_name, source_data_file, destination_data_file in files_to_upload
+            if source_data_file is None or file_name in uploaded_files
+        }
+        for future in as_completed(futures):
+            file_name = futures[future]
+            try:
+                url = future.result()
+            except dropbox.exceptions.ApiError as err:
+                pretty_print_error(
+                    f"Failed to get a shareable link for {file_name}: {err}"
+                )
+                continue
+            if url is None:
+                pretty_print_error(f"Failed to get a shareable link for {file_name}")
+                continue
+            # Create a tuple of the file name and the shareable link and add it to the list
+            file_links.append((file_name, url))
 
     # loop through the file_links list and write the sharable link to the corresponding file in data_to_share_links_folder
     for file_link in file_links:
@@ -1620,50 +3886,300 @@ def upload_data_files_to_dropbox_and_set_shareable_links(force=False):
                 )
 
 
-def validate_assignment_markdown(folders):
-    markdown_output_folder = config["project_markdown_output_folder"]
-    for folder in folders:
-        markdown_file = os.path.join(markdown_output_folder, folder, "document.md")
-        with open(markdown_file, "r") as f:
-            lines = f.readlines()
+def upload_file_to_dropbox(dbx, source_data_file, destination_data_file):
+    # Files that fit in a single chunk are uploaded directly. Larger files are
+    # uploaded in chunks to an upload session, which is returned uncommitted so
+    # that several sessions can be committed together.
+    chunk_size = config.get("dropbox_chunk_size", 8) * 1024 * 1024
 
-            in_code_block = False
-            headings = []
-            for line in lines:
-                stripped_line = line.strip().lower()
-                if stripped_line.startswith("```"):
-                    in_code_block = not in_code_block
-                elif not in_code_block and stripped_line.startswith("#"):
-                    headings.append(stripped_line)
-
-            assignment_pattern = re.compile(r"^# ", re.IGNORECASE)
-            question_pattern = re.compile(r"^#+ Question (\d+)$", re.IGNORECASE)
-            marks_pattern = re.compile(r"^#+ \d+ marks?", re.IGNORECASE)
-            answer_pattern = re.compile(r"^#+ Answer", re.IGNORECASE)
-
-            if not headings or not assignment_pattern.match(headings[0]):
-                return False
+    file_size = os.path.getsize(source_data_file)
+    if file_size <= chunk_size:
+        with open(source_data_file, "rb") as f:
+            dbx.files_upload(
+                f.read(),
+                destination_data_file,
+                mode=dropbox.files.WriteMode("overwrite"),
+            )
+        return None
+
+    # the session and the last offset acknowledged by Dropbox are recorded
+    # after every chunk, so an interrupted upload of the same content resumes
+    # where it stopped
+    path = os.path.abspath(source_data_file)
+    content_hash = get_dropbox_content_hash(source_data_file)
+    with build_state_lock:
+        row = build_state.execute(
+            """
+            SELECT destination, content_hash, session_id, offset
+            FROM upload_sessions WHERE path = ?
+            """,
+            (path,),
+        ).fetchone()
+
+    session_id = None
+    offset = 0
+    if row is not None and row[:2] == (destination_data_file, content_hash):
+        session_id, offset = row[2:]
+        pretty_print(
+            f"Resuming upload of {os.path.basename(source_data_file)} at byte {offset} of {file_size}",
+            True,
+        )
 
-            seen_question = False
-            seen_marks = False
-            last_question_number = 0
-
-            for heading in headings[1:]:
-                question_match = question_pattern.match(heading)
-                if question_match:
-                    question_number = int(question_match.group(1))
-                    if seen_question or question_number != last_question_number + 1:
-                        pretty_print_error(
-                            f"Incorrect question numbering in {markdown_file}"
+    with open(source_data_file, "rb") as f:
+        while session_id is None or offset < file_size:
+            f.seek(offset)
+            data = f.read(chunk_size)
+            # the session must be closed by its last chunk to be committed in
+            # a batch
+            close = offset + len(data) >= file_size
+            if session_id is None:
+                session_id = dbx.files_upload_session_start(
+                    data, close=close
+                ).session_id
+            else:
+                cursor = dropbox.files.UploadSessionCursor(
+                    session_id=session_id, offset=offset
+                )
+                try:
+                    dbx.files_upload_session_append_v2(data, cursor, close=close)
+                except dropbox.exceptions.ApiError as err:
+                    if not isinstance(err.error, dropbox.files.UploadSessionLookupError):
+                        raise
+                    if err.error.is_incorrect_offset():
+                        # continue from the offset Dropbox has received
+                        offset = err.error.get_incorrect_offset().correct_offset
+                    else:
+                        # the session has expired or can no longer be used
+                        pretty_print(
+                            f"Upload session for {os.path.basename(source_data_file)} is no longer valid, restarting",
+                            True,
                         )
-                        return False
-                    seen_question = True
-                    last_question_number = question_number
-                elif marks_pattern.match(heading) and seen_question:
-                    seen_marks = True
-                elif answer_pattern.match(heading) and seen_question and seen_marks:
-                    seen_question = False
-                    seen_marks = False
+                        session_id = None
+                        offset = 0
+                    continue
+            offset += len(data)
+
+            with build_state_lock, build_state:
+                build_state.execute(
+                    """
+                    INSERT OR REPLACE INTO upload_sessions
+                    (path, destination, content_hash, session_id, offset)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    (path, destination_data_file, content_hash, session_id, offset),
+                )
+
+    return dropbox.files.UploadSessionFinishArg(
+        cursor=dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset),
+        commit=dropbox.files.CommitInfo(
+            path=destination_data_file,
+            mode=dropbox.files.WriteMode("overwrite"),
+        ),
+    )
+
+
+def validate_assignment_markdown(documents):
+    source_folder = config["project_source_folder"]
+    for folder, content in documents.items():
+        markdown_file = os.path.join(source_folder, folder, "document.md")
+        assignment = parse_assignment_markdown(content)
+        lines = assignment["lines"]
+        headings = assignment["headings"]
+
+        if not headings or not lines[headings[0][0]].strip().startswith("# "):
+            return False
+
+        seen_question = False
+        seen_marks = False
+        last_question_number = 0
+
+        for _, kind, value in headings[1:]:
+            if kind == "question":
+                question_number = int(value)
+                if seen_question or question_number != last_question_number + 1:
+                    pretty_print_error(
+                        f"Incorrect question numbering in {markdown_file}"
+                    )
+                    return False
+                seen_question = True
+                last_question_number = question_number
+            elif kind == "marks" and seen_question:
+                seen_marks = True
+            elif kind == "answer" and seen_question and seen_marks:
+                seen_question = False
+                seen_marks = False
+
+
+def write_file_if_changed(file_path, content):
+    # Writes content to file_path unless the file already has this content.
+    # Returns True if the file was written.
+    if os.path.exists(file_path):
+        with open(file_path, "r") as f:
+            if f.read() == content:
+                return False
+    with open(file_path, "w") as f:
+        f.write(content)
+    return True
+
+
+def write_markdown_documents(documents):
+    # documents maps each folder to a dict of {file name: content}
+    markdown_output_folder = config["project_markdown_output_folder"]
+
+    for folder, files in documents.items():
+        folder_path = os.path.join(markdown_output_folder, folder)
+        os.makedirs(folder_path, exist_ok=True)
+
+        # remove the feedback Markdown files left by earlier builds
+        for file in os.listdir(folder_path):
+            if file.startswith("document_feedback_") and file not in files:
+                os.remove(os.path.join(folder_path, file))
+
+        # the files are replaced rather than rewritten, since they may be
+        # hard linked to the published copies (see copy_file)
+        for file, content in files.items():
+            file_path = os.path.join(folder_path, file)
+            with open(f"{file_path}.tmp", "w") as f:
+                f.write(content)
+            os.replace(f"{file_path}.tmp", file_path)
+
+
+def write_zip_central_directory(output, zinfos):
+    # Writes the central directory of the members written by write_zip_member
+    # to output, described by zinfos, followed by the end of central
+    # directory record. The ZIP64 end record and its locator are written
+    # before it when there are too many members or the zip is too large.
+    start = output.tell()
+    for zinfo in zinfos:
+        filename, flag_bits, dos_time, dos_date = get_zip_header_fields(zinfo)
+        file_size = zinfo.file_size
+        compress_size = zinfo.compress_size
+        header_offset = zinfo.header_offset
+        # the ZIP64 extra field holds the values that don't fit, in this order
+        zip64_values = []
+        if file_size >= zip64_limit or compress_size >= zip64_limit:
+            zip64_values += [file_size, compress_size]
+            file_size = compress_size = 0xFFFFFFFF
+        if header_offset >= zip64_limit:
+            zip64_values.append(header_offset)
+            header_offset = 0xFFFFFFFF
+        if zip64_values:
+            extra = struct.pack(
+                f"<HH{len(zip64_values)}Q", 1, 8 * len(zip64_values), *zip64_values
+            )
+            version = 45
+        else:
+            extra = b""
+            version = 20
+        output.write(
+            zip_central_header.pack(
+                zip_central_header_signature,
+                zinfo.create_system << 8 | version,
+                version,
+                flag_bits,
+                zinfo.compress_type,
+                dos_time,
+                dos_date,
+                zinfo.CRC,
+                compress_size,
+                file_size,
+                len(filename),
+                len(extra),
+                0,  # comment length
+                0,  # disk number
+                0,  # internal attributes
+                zinfo.external_attr,
+                header_offset,
+            )
+        )
+        output.write(filename)
+        output.write(extra)
+
+    end = output.tell()
+    count = len(zinfos)
+    size = end - start
+    offset = start
+    if count >= 0xFFFF or size >= zip64_limit or offset >= zip64_limit:
+        output.write(
+            zip64_end_record.pack(
+                zip64_end_record_signature,
+                zip64_end_record.size - 12,
+                45,
+                45,
+                0,
+                0,
+                count,
+                count,
+                size,
+                offset,
+            )
+        )
+        output.write(zip64_end_locator.pack(zip64_end_locator_signature, 0, end, 1))
+        count = min(count, 0xFFFF)
+        size = min(size, 0xFFFFFFFF)
+        offset = min(offset, 0xFFFFFFFF)
+    output.write(
+        zip_end_record.pack(zip_end_record_signature, 0, 0, count, count, size, offset, 0)
+    )
+
+
+def write_zip_member(output, zinfo, data_file):
+    # Writes a member to the end of output: its local header, followed by
+    # zinfo.compress_size bytes of data, already compressed with
+    # zinfo.compress_type, read from the current position of data_file. If
+    # zinfo.CRC is None the data must be stored, and its CRC-32 is computed
+    # while it is copied and then written into the header. Sets
+    # zinfo.header_offset for write_zip_central_directory.
+    filename, flag_bits, dos_time, dos_date = get_zip_header_fields(zinfo)
+    file_size = zinfo.file_size
+    compress_size = zinfo.compress_size
+    if file_size >= zip64_limit or compress_size >= zip64_limit:
+        extra = struct.pack("<HHQQ", 1, 16, file_size, compress_size)
+        file_size = compress_size = 0xFFFFFFFF
+        version = 45
+    else:
+        extra = b""
+        version = 20
+    compute_crc = zinfo.CRC is None
+    crc = 0 if compute_crc else zinfo.CRC
+
+    zinfo.header_offset = output.tell()
+    output.write(
+        zip_local_header.pack(
+            zip_local_header_signature,
+            version,
+            flag_bits,
+            zinfo.compress_type,
+            dos_time,
+            dos_date,
+            crc,
+            compress_size,
+            file_size,
+            len(filename),
+            len(extra),
+        )
+    )
+    output.write(filename)
+    output.write(extra)
+
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        chunk = data_file.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise EOFError(f"The data of {zinfo.filename} is truncated")
+        if compute_crc:
+            crc = zlib.crc32(chunk, crc)
+        output.write(chunk)
+        remaining -= len(chunk)
+
+    if compute_crc:
+        zinfo.CRC = crc
+        end = output.tell()
+        # the CRC-32 follows the signature, version, flags, compression
+        # method, time and date
+        output.seek(zinfo.header_offset + 14)
+        output.write(struct.pack("<I", crc))
+        output.seek(end)
 
 
 def main():
@@ -1754,6 +4270,19 @@ def main():
         action="store_true",
         help="Increase output verbosity.",
     )
+    process_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of documents to render in parallel (default: number of CPUs).",
+    )
+    process_parser.add_argument(
+        "--data-jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of files to compress in parallel when building data zips (default: number of CPUs).",
+    )
 
     # dropbox subcommand
     dropbox_parser = subparsers.add_parser(
@@ -1791,6 +4320,99 @@ def main():
         action="store_true",
         help="Increase output verbosity.",
     )
+    dropbox_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of documents to render in parallel (default: number of CPUs).",
+    )
+    dropbox_parser.add_argument(
+        "--data-jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of files to compress in parallel when building data zips (default: number of CPUs).",
+    )
+
+    # bench subcommand
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Time the processing of a generated project, from scratch, unchanged and with one document edited.",
+    )
+    bench_parser.add_argument(
+        "-n",
+        "--documents",
+        type=int,
+        default=20,
+        help="The number of documents to generate (default: 20).",
+    )
+    bench_parser.add_argument(
+        "--paragraphs",
+        type=int,
+        default=40,
+        help="The number of paragraphs in each document (default: 40).",
+    )
+    bench_parser.add_argument(
+        "--images",
+        type=int,
+        default=2,
+        help="The number of images in each document (default: 2).",
+    )
+    bench_parser.add_argument(
+        "--image-size",
+        type=int,
+        default=256,
+        help="The width and height of the images, in pixels (default: 256).",
+    )
+    bench_parser.add_argument(
+        "--data-files",
+        type=int,
+        default=4,
+        help="The number of data files of each document (default: 4).",
+    )
+    bench_parser.add_argument(
+        "--data-size",
+        type=int,
+        default=256,
+        help="The size of each data file, in KB (default: 256).",
+    )
+    bench_parser.add_argument(
+        "-q",
+        "--questions",
+        type=int,
+        default=0,
+        help="Generate assignments with this many questions, processed in 'assignment mode' (default: 0, no assignments).",
+    )
+    bench_parser.add_argument(
+        "--real-tools",
+        action="store_true",
+        help="Run the installed pandoc and lint tools instead of stubs.",
+    )
+    bench_parser.add_argument(
+        "-k",
+        "--keep",
+        action="store_true",
+        help="Keep the generated project instead of deleting it.",
+    )
+    bench_parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Increase output verbosity.",
+    )
+    bench_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of documents to render in parallel (default: number of CPUs).",
+    )
+    bench_parser.add_argument(
+        "--data-jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of files to compress in parallel when building data zips (default: number of CPUs).",
+    )
 
     args = parser.parse_args()
 
@@ -1798,6 +4420,10 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    if hasattr(args, "jobs") and (args.jobs < 1 or args.data_jobs < 1):
+        pretty_print_error("The number of jobs must be at least 1.")
+        sys.exit(1)
+
     if not (
         sys.version_info.major == required_major
         and sys.version_info.minor >= required_minor
@@ -1807,6 +4433,10 @@ def main():
         )
         sys.exit(1)
 
+    if args.command == "bench":
+        run_benchmark(args)
+        sys.exit(0)
+
     if hasattr(args, "config") and args.config:
         config_file_path = args.config
     else:
@@ -1829,6 +4459,11 @@ def main():
             "toc_title",
             "pandoc_highlight_style",
             "pandoc_pdf_engine",
+            "copy_mode",
+            "pdf_build_mode",
+            "link_checker",
+            "spellchecker",
+            "feedback_pdf_mode",
         ]:  # Skip keys
             config[key] = os.path.expanduser(value)
 
@@ -1850,11 +4485,72 @@ def main():
                 pretty_print_error(f"File does not exist: {value}")
                 sys.exit(1)
 
+    # projects created before the build cache was added keep it in "cache"
+    if not config.get("project_build_cache_folder"):
+        config["project_build_cache_folder"] = os.path.join(
+            config["project_root"], "cache"
+        )
+
+    if config.get("pdf_build_mode", "pandoc") not in pdf_build_modes:
+        pretty_print_error(
+            f"Invalid pdf_build_mode '{config['pdf_build_mode']}', use one of: {', '.join(pdf_build_modes)}"
+        )
+        sys.exit(1)
+
+    # only pdflatex can load the shared preamble from a precompiled format
+    if (
+        config.get("pdf_build_mode") == "cached"
+        and (config.get("pandoc_pdf_engine") or "pdflatex") != "pdflatex"
+    ):
+        pretty_print_emphasis(
+            f"The preamble is not precompiled for {config['pandoc_pdf_engine']} in cached mode, only for pdflatex"
+        )
+
+    if config.get("feedback_pdf_mode", "compile") not in feedback_pdf_modes:
+        pretty_print_error(
+            f"Invalid feedback_pdf_mode '{config['feedback_pdf_mode']}', use one of: {', '.join(feedback_pdf_modes)}"
+        )
+        sys.exit(1)
+
+    if config.get("feedback_pdf_mode", "compile") == "split" and not pypdf_available:
+        pretty_print_emphasis(
+            "pypdf is not installed, so feedback PDFs are compiled one by one (pip install pypdf)"
+        )
+
+    if config.get("link_checker", "markdown-link-check") not in link_checkers:
+        pretty_print_error(
+            f"Invalid link_checker '{config['link_checker']}', use one of: {', '.join(link_checkers)}"
+        )
+        sys.exit(1)
+
+    if config.get("spellchecker", "spellchecker") not in spellcheckers:
+        pretty_print_error(
+            f"Invalid spellchecker '{config['spellchecker']}', use one of: {', '.join(spellcheckers)}"
+        )
+        sys.exit(1)
+
+    if not 1 <= config.get("dropbox_chunk_size", 8) <= 150:
+        pretty_print_error("dropbox_chunk_size must be between 1 and 150 (MB).")
+        sys.exit(1)
+
+    if config.get("dropbox_upload_jobs", 4) < 1:
+        pretty_print_error("dropbox_upload_jobs must be at least 1.")
+        sys.exit(1)
+
+    if config.get("copy_mode", "auto") not in copy_modes:
+        pretty_print_error(
+            f"Invalid copy_mode '{config['copy_mode']}', use one of: {', '.join(copy_modes)}"
+        )
+        sys.exit(1)
+
     if args.command == "create":
         create_project(args.project, args.example)
         pretty_print(f"Project '{args.project}' created.", args.verbose)
         sys.exit(0)
 
+    if config.get("spellchecker", "spellchecker") == "builtin":
+        config.setdefault("spellchecker_dictionary", "/usr/share/dict/words")
+
     for key, value in config.items():
         if isinstance(value, str) and key in [
             "project_source_folder",
@@ -1889,16 +4585,6 @@ def main():
     # project_source_folder
     all_project_folders = get_folders_list(config["project_source_folder"])
 
-    # use project_folders_to_process to store the folders that need to be
-    # processed. Initially it will be the same as all_project_folders but it
-    # will be updated based on the command-line arguments and based on the
-    # folders that have modified documents or data files
-    project_folders_to_process = get_folders_list(config["project_source_folder"])
-
-    # use project_data_folders_to_process to store the folders that need new
-    # zip files generated because the data files have changed
-    project_data_folders_to_process = get_folders_list(config["project_source_folder"])
-
     pretty_print("Checking executables...", args.verbose)
     executables = {
         "pandoc": "https://www.python.org/downloads/",
@@ -1906,6 +4592,10 @@ def main():
         "spellchecker": "https://github.com/tbroadley/spellchecker-cli",
         "mdl": "https://github.com/markdownlint/markdownlint",
     }
+    if config.get("link_checker", "markdown-link-check") == "builtin":
+        del executables["markdown-link-check"]
+    if config.get("spellchecker", "spellchecker") == "builtin":
+        del executables["spellchecker"]
     check_executables(executables, args.verbose)
 
     if hasattr(args, "remove") and args.remove:
@@ -1921,34 +4611,33 @@ def main():
         import_markdown_files(args.markdown)
         sys.exit(0)
 
-    if hasattr(args, "force") and args.force:
-        pretty_print("Forcing reprocessing of all documents...", args.verbose)
-        for folder in all_project_folders:
-            pretty_print(f"Processing folder: {folder}", args.verbose)
-
-    else:
-        pretty_print("Checking for modified documents...", args.verbose)
-        project_folders_to_process = get_modified_folders(all_project_folders)
-        for folder in project_folders_to_process:
-            pretty_print(f"Processing folder: {folder}", args.verbose)
+    pretty_print("Loading build state...", args.verbose)
+    load_build_state()
+    snapshot_build_state(all_project_folders)
+    assignment = hasattr(args, "assignment") and args.assignment
+    fingerprints = get_artifact_fingerprints(all_project_folders, assignment)
 
+    # use project_data_folders_to_process to store the folders that need new
+    # zip files generated because the data files have changed
     if hasattr(args, "force") and args.force:
         pretty_print("Copying and compressing all data folders...", args.verbose)
-        for folder in all_project_folders:
-            pretty_print(f"Processing data folder: {folder}", args.verbose)
-        copy_and_compress_data_folders(all_project_folders)
+        project_data_folders_to_process = all_project_folders
     else:
         pretty_print("Copying and compressing modified data folders...", args.verbose)
-        project_data_folders_to_process = get_modified_data_folders(all_project_folders)
-        for folder in project_data_folders_to_process:
-            pretty_print(f"Processing data folder: {folder}", args.verbose)
-        copy_and_compress_data_folders(project_data_folders_to_process)
+        project_data_folders_to_process = get_stale_folders(
+            all_project_folders, "data", fingerprints
+        )
+    for folder in project_data_folders_to_process:
+        pretty_print(f"Processing data folder: {folder}", args.verbose)
+    compress_data_folders(project_data_folders_to_process, args.data_jobs, args.force)
+    record_artifacts(project_data_folders_to_process, "data", fingerprints)
 
     pretty_print("Publishing data...", args.verbose)
-    publish_data()
+    publish_data(all_project_folders, project_data_folders_to_process)
 
     pretty_print("Creating link files...", args.verbose)
-    create_link_files(project_folders_to_process)
+    create_link_files(all_project_folders)
+    snapshot_build_state(all_project_folders, kinds=("link",))
 
     if args.command == "dropbox":
         if not dropbox_available:
@@ -1959,78 +4648,153 @@ def main():
         if is_data_to_upload():
             pretty_print("Sharing data files using Dropbox...", args.verbose)
             upload_data_files_to_dropbox_and_set_shareable_links(args.force)
-
-            if not (hasattr(args, "force") and args.force):
-                # need to reprocess documents that have modified link files
-                project_folders_to_process = get_modified_folders(all_project_folders)
+            snapshot_build_state(all_project_folders, kinds=("link",))
         else:
             pretty_print("No data files to share", args.verbose)
 
+    # the documents are checked once the link files are up to date, since
+    # the data download links are inserted into the documents
+    fingerprints = get_artifact_fingerprints(all_project_folders, assignment)
+    if hasattr(args, "force") and args.force:
+        pretty_print("Forcing reprocessing of all documents...", args.verbose)
+        markdown_folders = all_project_folders
+        pdf_folders = all_project_folders
+        html_folders = all_project_folders
+        feedback_folders = all_project_folders
+    else:
+        pretty_print("Checking for modified documents...", args.verbose)
+        markdown_folders = get_stale_folders(all_project_folders, "markdown", fingerprints)
+        pdf_folders = get_stale_folders(all_project_folders, "pdf", fingerprints)
+        html_folders = get_stale_folders(all_project_folders, "html", fingerprints)
+        feedback_folders = get_stale_folders(all_project_folders, "feedback", fingerprints)
+    # HTML is only generated outside of assignment mode, and feedback PDFs
+    # only in assignment mode
+    if assignment:
+        html_folders = []
+    else:
+        feedback_folders = []
+
+    # use project_folders_to_process to store the folders whose Markdown is
+    # transformed, which is every folder with an artifact to rebuild
+    project_folders_to_process = [
+        folder
+        for folder in all_project_folders
+        if folder in markdown_folders
+        or folder in pdf_folders
+        or folder in html_folders
+        or folder in feedback_folders
+    ]
+    for folder in project_folders_to_process:
+        pretty_print(f"Processing folder: {folder}", args.verbose)
+
     pretty_print("Copying source folders to Markdown output...", args.verbose)
     copy_source_folders_to_markdown_output(project_folders_to_process)
 
-    pretty_print("Editing Markdown includes...", args.verbose)
-    edit_markdown_includes(project_folders_to_process)
-
-    pretty_print("Running spellchecker...", args.verbose)
-    run_spellchecker(project_folders_to_process)
-
-    pretty_print("Running Markdown link check...", args.verbose)
-    run_markdown_link_check(project_folders_to_process)
-
-    pretty_print("Running Markdown lint...", args.verbose)
-    run_markdown_lint(project_folders_to_process)
-
     pretty_print(
-        "Replacing [DATA_DOWNLOAD_LINK] with data links in Markdown...", args.verbose
+        "Running spellchecker, Markdown link check and Markdown lint...",
+        args.verbose,
+    )
+    if (
+        markdown_folders
+        and config.get("spellchecker", "spellchecker") == "builtin"
+        and not check_file_exists(config["spellchecker_dictionary"])
+    ):
+        sys.exit(1)
+    run_lint_tools(markdown_folders)
+
+    pretty_print("Transforming Markdown...", args.verbose)
+    transforms = [
+        ("includes", transform_includes),
+        ("data download links", transform_data_download_links),
+    ]
+    if not assignment:
+        transforms.append(("license", transform_license))
+    documents = transform_markdown(
+        load_markdown_documents(project_folders_to_process), transforms
     )
-    replace_data_download_links_in_markdown(project_folders_to_process)
 
-    if hasattr(args, "assignment") and args.assignment:
+    if assignment:
         pretty_print("Processing documents as assignments...", args.verbose)
 
         pretty_print("Validating assignment Markdown...", args.verbose)
-        validate_assignment_markdown(project_folders_to_process)
+        validate_assignment_markdown(documents)
 
         pretty_print("Generating new Markdown...", args.verbose)
-        generate_assignment_markdown(project_folders_to_process)
+        assignment_documents = generate_assignment_markdown(documents)
+        write_markdown_documents(assignment_documents)
+        print_transform_timings(args.verbose)
 
         pretty_print("Generating PDFs...", args.verbose)
-        generate_assignment_pdfs(project_folders_to_process)
+        failures = generate_assignment_pdfs(
+            assignment_documents, pdf_folders, feedback_folders, args.jobs
+        )
 
         pretty_print("Publishing PDFs...", args.verbose)
-        publish_assignment_pdfs()
+        publish_assignment_pdfs(all_project_folders, project_folders_to_process)
+
+        pretty_print("Recording build state...", args.verbose)
+        failed = set(failure[0] for failure in failures)
+        record_artifacts(project_folders_to_process, "markdown", fingerprints, True)
+        for artifact, folders in [("pdf", pdf_folders), ("feedback", feedback_folders)]:
+            record_artifacts(
+                [f for f in folders if (f, artifact) not in failed],
+                artifact,
+                fingerprints,
+                True,
+            )
 
-        pretty_print("Creating timestamp files...", args.verbose)
-        create_timestamp_files(project_folders_to_process)
+        if failures:
+            report_failures(failures)
+            sys.exit(1)
 
         pretty_print("🎉🎉🎉   Done.", args.verbose)
 
         sys.exit(0)
 
+    # the PDF and HTML are rendered from the Markdown before page breaks are
+    # removed, so that both are rendered from the same cached AST
+    pretty_print("Removing page breaks...", args.verbose)
+    markdown_documents = transform_markdown(
+        documents, [("page breaks", transform_pagebreaks)]
+    )
+
     pretty_print("Generating new Markdown...", args.verbose)
-    generate_markdown(project_folders_to_process)
+    write_markdown_documents(
+        {folder: {"document.md": content} for folder, content in markdown_documents.items()}
+    )
+    print_transform_timings(args.verbose)
 
     pretty_print("Generating PDFs...", args.verbose)
-    generate_pdfs(project_folders_to_process)
-
-    pretty_print("Removing page breaks...", args.verbose)
-    remove_pagebreaks(project_folders_to_process)
+    pdf_failures = generate_pdfs(
+        {folder: documents[folder] for folder in pdf_folders}, args.jobs
+    )
 
     pretty_print("Generating HTMLs...", args.verbose)
-    generate_htmls(project_folders_to_process)
+    html_failures = generate_htmls(
+        {folder: documents[folder] for folder in html_folders}, args.jobs
+    )
 
     pretty_print("Publishing PDFs...", args.verbose)
-    publish_pdfs()
+    publish_pdfs(all_project_folders, project_folders_to_process)
 
     pretty_print("Publishing Markdown...", args.verbose)
-    publish_markdown()
+    publish_markdown(all_project_folders, project_folders_to_process)
 
     pretty_print("Publishing HTMLs...", args.verbose)
-    publish_htmls()
+    publish_htmls(all_project_folders, project_folders_to_process)
+
+    pretty_print("Recording build state...", args.verbose)
+    failures = pdf_failures + html_failures
+    failed = set(failure[0] for failure in failures)
+    record_artifacts(project_folders_to_process, "markdown", fingerprints)
+    for artifact, folders in [("pdf", pdf_folders), ("html", html_folders)]:
+        record_artifacts(
+            [f for f in folders if (f, artifact) not in failed], artifact, fingerprints
+        )
 
-    pretty_print("Creating timestamp files...", args.verbose)
-    create_timestamp_files(project_folders_to_process)
+    if failures:
+        report_failures(failures)
+        sys.exit(1)
 
     pretty_print("🎉🎉🎉   Done.", args.verbose)
 